@@ -118,6 +118,65 @@ def compute_velocity(buoy_df, date_index=True, rotate_uv=False, method='c'):
     return buoy_df
 
 
+VELOCITY_METHODS = {'f': 'f', 'forward': 'f', 'b': 'b', 'backward': 'b',
+                    'c': 'c', 'centered': 'c',
+                    'fb': 'fb', 'bf': 'fb', 'forward_backward': 'fb'}
+
+
+def velocity_kernel(t, x, y, methods=('f', 'b', 'c', 'fb')):
+    """Array version of compute_velocity. Computes the velocity for each of <methods>
+    from int64 times <t> in nanoseconds and positions <x> and <y> in meters, sharing
+    the time steps and differences between the methods. <x> and <y> can have leading
+    dimensions before the time axis. Returns a dictionary with the short method
+    names ('f', 'b', 'c', 'fb') as keys and (u, v) arrays as values.
+
+    As in compute_velocity, the centered and forward-backward velocities switch to
+    forward (backward) differences at the first (last) point after (before) a gap,
+    i.e. where the time steps on the two sides differ by more than twice the
+    shorter one.
+    """
+    methods = set(VELOCITY_METHODS[m] for m in methods)
+    t = np.asarray(t, dtype=np.int64)
+    X = np.stack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)])
+    n = len(t)
+
+    dt = np.diff(t).astype(float) / 1e9
+    dX = np.diff(X, axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        step = dX / dt
+    # Forward and backward differences, NaN where there is no neighbor
+    edge = np.full(X.shape[:-1] + (1,), np.nan)
+    fwd = np.concatenate([step, edge], axis=-1)
+    bwd = np.concatenate([edge, step], axis=-1)
+
+    result = {}
+    if 'f' in methods:
+        result['f'] = (fwd[0], fwd[1])
+    if 'b' in methods:
+        result['b'] = (bwd[0], bwd[1])
+    if 'c' in methods or 'fb' in methods:
+        dtn = np.append(dt, np.nan)
+        dtp = np.insert(dt, 0, np.nan)
+        with np.errstate(invalid='ignore'):
+            min_dt = np.fmin(dtp, dtn)
+            # bwd endpoint means the next expected obs is missing: last data before gap
+            bwd_endpoint = (dtp < dtn) & (np.abs(dtp - dtn) > 2*min_dt)
+            fwd_endpoint = (dtp > dtn) & (np.abs(dtp - dtn) > 2*min_dt)
+
+        for method in methods & {'c', 'fb'}:
+            if method == 'c':
+                U = np.full(X.shape, np.nan)
+                if n > 2:
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        U[..., 1:-1] = (X[..., 2:] - X[..., :-2]) / ((t[2:] - t[:-2]) / 1e9)
+            else:
+                U = np.sign(bwd) * np.fmin(np.abs(fwd), np.abs(bwd))
+            U = np.where(fwd_endpoint, fwd, U)
+            U = np.where(bwd_endpoint, bwd, U)
+            result[method] = (U[0], U[1])
+    return result
+
+
 def compute_absolute_dispersion(vel_varname, data, max_length='30D', step_size=3600):
     """Computes the absolute dispersion for buoys in data. Data need
     to be aligned to a common time step. Assumes the start time is time 0,
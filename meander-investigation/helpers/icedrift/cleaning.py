@@ -3,15 +3,22 @@
 Functions starting with "check" return a boolean Series with True where the 
 data is likely bad.
 
+standard_qc_batch runs the QC on the data of many buoys at once and flags the
+observations that fail with a bitmask (see QC_FLAGS) instead of dropping them.
+It follows the icedrift package in uncertainty-quantification/scripts.
+
 
 
 TBD: Currently, columns are added. This should be optional.
 """
 
+import warnings
 import pandas as pd
 import numpy as np
 import pyproj
-from .analysis import compute_velocity
+from .analysis import compute_velocity, velocity_kernel
+from .projection import project
+from .rolling import window_bounds, rolling_count, rolling_mean_std, rolling_median
 
 def check_positions(data, pairs_only=False,
                    latname='latitude', lonname='longitude'):
@@ -245,4 +252,408 @@ def standard_qc(buoy_df,
     if len(buoy_df_init) < min_size:
         return None
     else:
-        return buoy_df_init
\ No newline at end of file
+        return buoy_df_init
+
+
+def duplicated_pairs(x, y, consecutive=False, group=None):
+    """Marks the (x, y) pairs that repeat an earlier pair, or with consecutive=True
+    only those that repeat the pair right before them. If <group> is given, only
+    pairs within the same group are compared. As in pandas, NaN values are equal
+    to each other.
+
+    Each coordinate is replaced by the integer code of its value among the unique
+    values, and the codes are packed into one int64 key per pair, so the search is
+    a single pass over integers instead of hashing a Python tuple per row."""
+    codes = [pd.factorize(np.asarray(v), use_na_sentinel=False)[0].astype(np.int64)
+             for v in (x, y)]
+    key = codes[0] * (codes[1].max(initial=0) + 1) + codes[1]
+    if group is not None:
+        key = pd.factorize(key)[0].astype(np.int64)
+        key = pd.factorize(np.asarray(group))[0].astype(np.int64) * (key.max(initial=0) + 1) + key
+
+    if consecutive:
+        duplicated = np.zeros(len(key), dtype=bool)
+        duplicated[1:] = key[1:] == key[:-1]
+    else:
+        duplicated = pd.Index(key).duplicated(keep='first')
+    return duplicated
+
+
+def _fb_track_velocity(t, X):
+    """Forward-backward velocity along the full track."""
+    return np.vstack(velocity_kernel(t, X[0], X[1], methods=['fb'])['fb'])
+
+
+def _chunks(t, chunk_size, margin):
+    """Splits the sorted int64 times <t> into chunks of <chunk_size> observations,
+    or a single chunk if chunk_size is None. Yields (a, b, ca, cb), where the chunk
+    is t[a:b] and its context t[ca:cb] adds the observations within <margin> of the
+    chunk and one more on either side."""
+    n = len(t)
+    if chunk_size is None:
+        chunk_size = max(n, 1)
+    for a in range(0, n, chunk_size):
+        b = min(a + chunk_size, n)
+        ca = max(np.searchsorted(t, t[a] - margin, side='left') - 1, 0)
+        cb = min(np.searchsorted(t, t[b - 1] + margin, side='right') + 1, n)
+        yield a, b, ca, cb
+
+
+def _speed_flags(t, X, lat, window='3day', sigma=5, max_speed=1.5, chunk_size=None):
+    """Array version of check_speed. <t> are the observation times, <X> the (2, n)
+    projected positions and <lat> the latitudes, whose count sets the minimum
+    number of observations in a window.
+
+    If <chunk_size> is given, the track is processed that many observations at a
+    time, each chunk with 2 windows of context on either side. This covers all the
+    data that the Z-scores and their leave-one-out updates depend on, and the
+    Z-scores are carried from one chunk to the next, so the flags are the same as
+    for the whole track while the rolling arrays only span a chunk."""
+    t = pd.DatetimeIndex(t).asi8
+    X = np.asarray(X, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    window = pd.to_timedelta(window)
+    n = len(t)
+    w = window.value
+    w_loo = (1.5*window).value
+    w_update = (0.5*window).value
+    chunks = list(_chunks(t, chunk_size, 2*w))
+
+    counts = np.zeros(n)
+    for a, b, ca, cb in chunks:
+        counts[a:b] = rolling_count(t[ca:cb], lat[ca:cb], window)[a - ca:b - ca]
+    n_min = 0.4*np.median(counts) if n > 0 else 0
+
+    if n_min > 0:
+        n_min = int(n_min)
+    else:
+        # print('n_min is', n_min, ', setting it to 10.')
+        n_min = 10
+        
+    def zscore(t, U, window, n_min):
+        # u and v are handled together by the rolling kernels
+        mean, std = rolling_mean_std(t, U, window, min_periods=n_min)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            score = (U - mean) / std
+
+        z_anom = score - rolling_median(t, score, window, min_periods=n_min)
+        return z_anom[0], z_anom[1]
+
+    def leave_one_out(t, X, U):
+        """Returns zscore_without for the track (t, X) with velocities U."""
+        loo_start = np.searchsorted(t, t - w_loo, side='right')
+        loo_end = np.searchsorted(t, t + w_loo, side='left')
+        win_start, win_end = window_bounds(t, w)
+
+        # Shift by the mean before summing so the cumulative sums keep their precision
+        valid = ~np.isnan(U)
+        U_ref = np.nanmean(U, axis=1, keepdims=True) if valid.any() else np.zeros((2, 1))
+        dU = np.where(valid, U - U_ref, 0)
+        csum_n = np.concatenate([np.zeros((2, 1)), np.cumsum(valid, axis=1)], axis=1)
+        csum_1 = np.concatenate([np.zeros((2, 1)), np.cumsum(dU, axis=1)], axis=1)
+        csum_2 = np.concatenate([np.zeros((2, 1)), np.cumsum(dU**2, axis=1)], axis=1)
+
+        def zscore_without(k):
+            """Z-scores within half a window of position k after removing k, matching
+            a call to zscore on compute_velocity of the data within 1.5 windows of k."""
+            lo, hi = loo_start[k], loo_end[k]
+
+            # Velocities that change: the neighbors of k and the ends of the subset
+            changed = np.unique([c for c in (k - 1, k + 1, lo, hi - 1) if lo <= c < hi and c != k])
+            prev = changed - 1 - (changed - 1 == k)
+            nxt = changed + 1 + (changed + 1 == k)
+            prev = np.where(prev >= lo, prev, -1)
+            nxt = np.where(nxt < hi, nxt, -1)
+            U_new = _fb_velocity(t, X, prev, changed, nxt)
+
+            # Points whose score is needed for the medians, and the points to update
+            q = np.arange(lo, hi)
+            q = q[(np.abs(t[q] - t[k]) < w) & (q != k)]
+            p = q[np.abs(t[q] - t[k]) < w_update]
+            if len(p) == 0:
+                return p, np.empty((2, 0))
+
+            qs, qe = win_start[q], win_end[q]
+            n = csum_n[:, qe] - csum_n[:, qs]
+            s1 = csum_1[:, qe] - csum_1[:, qs]
+            s2 = csum_2[:, qe] - csum_2[:, qs]
+            for c, u_new in zip([k] + list(changed), [np.full(2, np.nan)] + list(U_new.T)):
+                inside = (qs <= c) & (c < qe)
+                old_ok = valid[:, c]
+                new_ok = ~np.isnan(u_new)
+                du_old = np.where(old_ok, U[:, c] - U_ref[:, 0], 0)
+                du_new = np.where(new_ok, u_new - U_ref[:, 0], 0)
+                n += inside * (new_ok.astype(int) - old_ok)[:, None]
+                s1 += inside * (du_new - du_old)[:, None]
+                s2 += inside * (du_new**2 - du_old**2)[:, None]
+
+            U_q = U[:, q].copy()
+            U_q[:, np.searchsorted(q, changed[np.isin(changed, q)])] = U_new[:, np.isin(changed, q)]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = s1 / n
+                std = np.sqrt(np.maximum(s2 - s1 * mean, 0) / (n - 1))
+                score = (U_q - U_ref - mean) / std
+            score[(n < max(n_min, 1)) | (n < 2)] = np.nan
+
+            # Rolling median of the scores around each updated point
+            ps, pe = win_start[p], win_end[p]
+            width = pe - ps
+            cols = ps[:, None] + np.arange(width.max())[None, :]
+            cols = np.where(cols < pe[:, None], cols, -1)
+            cols = np.where(cols == k, -1, cols)
+            pos = np.searchsorted(q, cols)
+            pos = np.minimum(pos, len(q) - 1)
+            stacked = np.where(cols >= 0, score[:, pos], np.nan)
+            count = (~np.isnan(stacked)).sum(axis=2)
+            with warnings.catch_warnings():
+                # All-NaN windows are expected near gaps
+                warnings.simplefilter('ignore', RuntimeWarning)
+                median = np.nanmedian(stacked, axis=2)
+            median[count < n_min] = np.nan
+
+            return p, score[:, np.searchsorted(q, p)] - median
+
+        return zscore_without
+
+    # Calculate speed using the forward-backward difference and get Z-scores. Anytime
+    # the Z score for U or V velocity is larger than 3, re-calculate Z scores leaving
+    # that value out. Removing a point only changes the velocities of its neighbors,
+    # so the rolling sums are updated for the windows containing those points and the
+    # Z-scores are refreshed within half a window of the point.
+    # Probably should replace with a while loop so that it can iterate a few times
+    zu = np.full(n, np.nan)
+    zv = np.full(n, np.nan)
+    has_u = np.zeros(n, dtype=bool)
+    exceed = np.zeros(n, dtype=bool)
+    init_hi = 0
+    for a, b, ca, cb in chunks:
+        tc, Xc = t[ca:cb], X[:, ca:cb]
+        U = _fb_track_velocity(tc, Xc)
+
+        # Initial Z-scores for the points that the loop below can reach first;
+        # the others hold the Z-scores left by the previous chunk
+        hi = max(np.searchsorted(t, t[b - 1] + w_update, side='left'), b)
+        new = slice(init_hi - ca, hi - ca)
+        zu_c, zv_c = zscore(tc, U, window, n_min)
+        zu[init_hi:hi] = zu_c[new]
+        zv[init_hi:hi] = zv_c[new]
+        has_u[init_hi:hi] = ~np.isnan(U[0, new])
+        exceed[init_hi:hi] = (np.abs(zu_c[new]) > 3) | (np.abs(zv_c[new]) > 3)
+        init_hi = hi
+
+        zscore_without = leave_one_out(tc, Xc, U)
+        for k in range(a, b):
+            if exceed[k]:
+                p, z_new = zscore_without(k - ca)
+                p = p + ca
+                zu[p] = z_new[0]
+                zv[p] = z_new[1]
+                exceed[p] = (np.abs(z_new[0]) > 3) | (np.abs(z_new[1]) > 3)
+
+    flag = has_u & ((np.abs(zu) > sigma) | (np.abs(zv) > sigma))
+
+    # Check the speed of the remaining points
+    keep = np.flatnonzero(~flag)
+    for a, b, _, _ in _chunks(keep, chunk_size, 0):
+        j = np.arange(a, b)
+        prev = np.where(j > 0, keep[j - 1], -1)
+        nxt = np.where(j + 1 < len(keep), keep[np.minimum(j + 1, len(keep) - 1)], -1)
+        U = _fb_velocity(t, X, prev, keep[j], nxt)
+        flag[keep[j]] = np.sqrt(U[0]**2 + U[1]**2) > max_speed
+
+    return flag
+
+def _fb_velocity(t, X, prev, cur, nxt):
+    """Forward-backward velocity at positions <cur> of the int64 times <t> and the
+    (2, n) position array <X>, using <prev> and <nxt> as the neighboring positions
+    (-1 where there is none). Follows compute_velocity(method='fb'), including the
+    use of one-sided differences next to gaps."""
+    has_prev = prev >= 0
+    has_next = nxt >= 0
+    dtp = np.where(has_prev, (t[cur] - t[prev]).astype(float), np.nan)
+    dtn = np.where(has_next, (t[nxt] - t[cur]).astype(float), np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        bwd = np.where(has_prev, (X[:, cur] - X[:, prev]) / (dtp / 1e9), np.nan)
+        fwd = np.where(has_next, (X[:, nxt] - X[:, cur]) / (dtn / 1e9), np.nan)
+        min_dt = np.fmin(dtp, dtn)
+        bwd_endpoint = (dtp < dtn) & (np.abs(dtp - dtn) > 2*min_dt)
+        fwd_endpoint = (dtp > dtn) & (np.abs(dtp - dtn) > 2*min_dt)
+        U = np.sign(bwd) * np.fmin(np.abs(fwd), np.abs(bwd))
+    U = np.where(fwd_endpoint, fwd, U)
+    U = np.where(bwd_endpoint, bwd, U)
+    return U
+
+
+#### Batched QC algorithm ####
+# Bits of the QC mask, one per step of standard_qc. A mask of 0 means the
+# observation passed every check.
+QC_DATE = 1        # duplicated or reversed time (check_dates)
+QC_POSITION = 2    # duplicated or invalid position (check_positions)
+QC_BBOX = 4        # before the first or after the last fix in the bounding box
+QC_GAP = 8         # in a segment too short between gaps (check_gaps)
+QC_SPEED = 16      # anomalous velocity (check_speed)
+QC_SIZE = 32       # the track had too few observations left at a size check
+
+QC_FLAGS = {'date': QC_DATE, 'position': QC_POSITION, 'bbox': QC_BBOX,
+            'gap': QC_GAP, 'speed': QC_SPEED, 'size': QC_SIZE}
+
+
+def qc_mask_batch(buoy, t, lat, lon, x=None, y=None,
+                  min_size=100,
+                  gap_threshold='6H',
+                  segment_length=24,
+                  lon_range=(-180, 180),
+                  lat_range=(65, 90),
+                  max_speed=1.5,
+                  speed_window='3D',
+                  speed_sigma=4,
+                  verbose=False,
+                  chunk_size=None):
+    """Runs qc_mask on many buoys at once. The data are in long format, with <buoy>
+    giving the buoy of each observation, and must be grouped by buoy and sorted by
+    time within each buoy. <gap_threshold> is either a single value or a Series of
+    thresholds indexed by buoy. The mask of each buoy is the same as qc_mask in
+    the uncertainty-quantification icedrift package would give for that buoy alone.
+
+    The date, position, bounding box, size and gap checks are done for all buoys
+    together, with every comparison between neighboring observations and every
+    duplicate search restricted to observations of the same buoy. The speed check
+    runs on the arrays of one buoy at a time, since its leave-one-out updates
+    are sequential anyway."""
+
+    buoy = np.asarray(buoy)
+    t = pd.DatetimeIndex(t).asi8
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    n = len(t)
+    mask = np.zeros(n, dtype=np.uint8)
+    if n == 0:
+        return mask
+
+    # Group number of each observation, and the first observation of each group
+    new_group = np.ones(n, dtype=bool)
+    new_group[1:] = buoy[1:] != buoy[:-1]
+    group = np.cumsum(new_group) - 1
+    first = np.flatnonzero(new_group)
+    n_groups = len(first)
+    if len(pd.unique(buoy)) != n_groups:
+        raise ValueError('data must be grouped by buoy')
+    same = ~new_group[1:]
+
+    # Dates: duplicates and reversals within each buoy
+    date = pd.DatetimeIndex(t).round('1min').asi8
+    duplicated_times = pd.DataFrame({'g': group, 't': date}).duplicated(keep='first').values
+    nat = date == np.iinfo(np.int64).min
+    reversed_times = np.zeros(n, dtype=bool)
+    reversed_times[1:] = same & (date[1:] < date[:-1]) & ~nat[1:] & ~nat[:-1]
+    mask[duplicated_times | reversed_times] |= QC_DATE
+
+    # Positions: the longitude convention is chosen per buoy, as in check_positions
+    lats = np.round(lat, 10)
+    lons = np.round(lon, 10)
+    any_negative = np.bincount(group, weights=lons < 0, minlength=n_groups) > 0
+    invalid_lons = np.where(any_negative[group], np.abs(lons) > 180, lons > 360)
+    invalid = (np.abs(lats) > 90) | invalid_lons
+    duplicated = duplicated_pairs(lons, lats, group=group)
+    mask[invalid | duplicated] |= QC_POSITION
+    idx = np.flatnonzero(mask == 0)
+
+    # Bounding box: keep each buoy from its first to its last time in the box
+    g = group[idx]
+    in_box = (lon[idx] > lon_range[0]) & (lon[idx] < lon_range[1]) & \
+             (lat[idx] > lat_range[0]) & (lat[idx] < lat_range[1])
+    box_groups, box_first = np.unique(g[in_box], return_index=True)
+    box_last = np.sum(in_box) - 1 - np.unique(g[in_box][::-1], return_index=True)[1]
+    has_box = np.zeros(n_groups, dtype=bool)
+    has_box[box_groups] = True
+    t_first = np.zeros(n_groups, dtype=np.int64)
+    t_last = np.zeros(n_groups, dtype=np.int64)
+    t_first[box_groups] = t[idx][in_box][box_first]
+    t_last[box_groups] = t[idx][in_box][box_last]
+    outside = ~has_box[g] | (t[idx] < t_first[g]) | (t[idx] > t_last[g])
+    mask[idx[outside]] |= QC_BBOX
+    idx = idx[~outside]
+
+    # Buoys with insufficient data are rejected and left out of later checks
+    rejected = np.bincount(group[idx], minlength=n_groups) < min_size
+    idx = idx[~rejected[group[idx]]]
+
+    # Gaps: segments restart at every new buoy
+    if isinstance(gap_threshold, pd.Series):
+        tg = pd.to_timedelta(gap_threshold.reindex(buoy[first]).values).asi8
+    else:
+        tg = np.full(n_groups, pd.to_timedelta(gap_threshold).value)
+    g = group[idx]
+    breaks = np.ones(len(idx), dtype=bool)
+    breaks[1:] = (g[1:] != g[:-1]) | (np.diff(t[idx]) > tg[g[1:]])
+    segment = np.cumsum(breaks) - 1
+    short = np.bincount(segment)[segment] <= segment_length
+    mask[idx[short]] |= QC_GAP
+    idx = idx[~short]
+
+    # Speed, one buoy at a time
+    if x is None or y is None:
+        X = np.vstack(project(lon[idx], lat[idx]))
+    else:
+        X = np.vstack([np.asarray(x, dtype=float)[idx], np.asarray(y, dtype=float)[idx]])
+    bounds = np.flatnonzero(np.diff(group[idx], prepend=-1, append=n_groups))
+    fast = np.zeros(len(idx), dtype=bool)
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        fast[a:b] = _speed_flags(t[idx[a:b]], X[:, a:b], lat[idx[a:b]], window=speed_window,
+                                 sigma=speed_sigma, max_speed=max_speed, chunk_size=chunk_size)
+    mask[idx[fast]] |= QC_SPEED
+    idx = idx[~fast]
+
+    rejected |= np.bincount(group[idx], minlength=n_groups) < min_size
+    mask[rejected[group]] |= QC_SIZE
+    if verbose:
+        print(np.sum(rejected), 'of', n_groups, 'buoys have less than min size', min_size)
+    return mask
+
+
+def standard_qc_batch(data,
+                      buoy_col='BuoyID',
+                      date_col=None,
+                      min_size=100,
+                      gap_threshold='6H',
+                      segment_length=24,
+                      lon_range=(-180, 180),
+                      lat_range=(65, 90),
+                      max_speed=1.5,
+                      speed_window='3D',
+                      speed_sigma=4,
+                      verbose=False,
+                      chunk_size=None):
+    """standard_qc for a long-format dataframe with the data of many buoys, such as
+    an IABP yearly file, grouped by <buoy_col> and sorted by time within each buoy.
+    If <date_col> is not specified, the times are taken from the index. Returns a
+    copy of the data with 'flag' and 'qc_mask' columns. Instead of returning None
+    for buoys with too little data, all of their observations are flagged and have
+    QC_SIZE set. The observations that pass are those that standard_qc returns for
+    each buoy. See qc_mask_batch for the other arguments."""
+
+    if date_col is None:
+        date = pd.to_datetime(data.index.values)
+    else:
+        date = pd.to_datetime(data[date_col])
+    if 'x' in data.columns:
+        x, y = data['x'].values, data['y'].values
+    else:
+        x, y = None, None
+    mask = qc_mask_batch(data[buoy_col].values, date,
+                         data['latitude'].values, data['longitude'].values, x, y,
+                         min_size=min_size,
+                         gap_threshold=gap_threshold,
+                         segment_length=segment_length,
+                         lon_range=lon_range,
+                         lat_range=lat_range,
+                         max_speed=max_speed,
+                         speed_window=speed_window,
+                         speed_sigma=speed_sigma,
+                         verbose=verbose,
+                         chunk_size=chunk_size)
+
+    data = data.copy()
+    data['flag'] = mask > 0
+    data['qc_mask'] = mask
+    return data
@@ -0,0 +1,127 @@
+"""Rolling statistics over centered time windows for irregularly sampled data.
+
+The functions here reproduce pandas rolling(window, center=True) for a datetime
+index, with windows covering (t - window/2, t + window/2], but work directly on
+NumPy arrays. Inputs can be a single series of shape (n,) or several series
+sharing the same times with shape (m, n), e.g. the u and v velocity components,
+in which case all series are computed in one pass.
+
+Times can be given as a DatetimeIndex or as int64 nanoseconds, and must be
+sorted. As in pandas, NaN and infinite values are skipped and results are NaN
+where fewer than min_periods valid values are in the window.
+
+The window bounds are computed once per call and shared by all series. Means and
+standard deviations come from running sums; medians and maxima reuse the sliding
+order-statistics structures of the pandas rolling aggregations with those bounds.
+"""
+import numpy as np
+import pandas as pd
+from pandas.api.indexers import BaseIndexer
+
+
+def _as_int64(t):
+    """Returns the times as a sorted int64 array of nanoseconds."""
+    if isinstance(t, np.ndarray) and t.dtype == np.int64:
+        t_ns = t
+    else:
+        t_ns = pd.DatetimeIndex(t).asi8
+    if np.any(np.diff(t_ns) < 0):
+        raise ValueError('times must be monotonic')
+    return t_ns
+
+
+def _prep_values(X):
+    """Returns X as a float array with infinite values replaced by NaN."""
+    X = np.asarray(X, dtype=float)
+    return np.where(np.isinf(X), np.nan, X)
+
+
+def _as_window(window):
+    """Returns the window length in nanoseconds."""
+    if isinstance(window, (int, np.integer)):
+        return int(window)
+    return pd.to_timedelta(window).value
+
+
+def window_bounds(t, window):
+    """Start and end positions of the centered time window around each time in <t>,
+    so that the window around t[i] is t[start[i]:end[i]]. Since the windows only move
+    forward, the bounds are found with a binary search rather than a scan."""
+    t = _as_int64(t)
+    window = _as_window(window)
+    half = window // 2
+    start = np.searchsorted(t, t - half - window % 2, side='right')
+    end = np.searchsorted(t, t + half, side='right')
+    return start, end
+
+
+def rolling_count(t, X, window):
+    """Number of non-NaN values in the centered window around each time. As with
+    pandas count, infinite values are counted."""
+    X = np.asarray(X, dtype=float)
+    start, end = window_bounds(t, window)
+    csum = np.cumsum(~np.isnan(X), axis=-1)
+    csum = np.concatenate([np.zeros(X.shape[:-1] + (1,)), csum], axis=-1)
+    return csum[..., end] - csum[..., start]
+
+
+def rolling_mean_std(t, X, window, min_periods=1, ddof=1):
+    """Rolling mean and standard deviation over centered time windows. The sums are
+    taken from running totals of the values, which are first shifted by their mean
+    so that differences of the totals keep their precision. Returns (mean, std) with
+    the same shape as X."""
+    X = _prep_values(X)
+    start, end = window_bounds(t, window)
+    valid = ~np.isnan(X)
+    with np.errstate(invalid='ignore'):
+        ref = np.nanmean(X, axis=-1, keepdims=True) if valid.any() else 0.
+    ref = np.where(np.isnan(ref), 0., ref)
+    dX = np.where(valid, X - ref, 0.)
+
+    pad = np.zeros(X.shape[:-1] + (1,))
+    csum_n = np.concatenate([pad, np.cumsum(valid, axis=-1)], axis=-1)
+    csum_1 = np.concatenate([pad, np.cumsum(dX, axis=-1)], axis=-1)
+    csum_2 = np.concatenate([pad, np.cumsum(dX**2, axis=-1)], axis=-1)
+
+    n = csum_n[..., end] - csum_n[..., start]
+    s1 = csum_1[..., end] - csum_1[..., start]
+    s2 = csum_2[..., end] - csum_2[..., start]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = s1 / n
+        var = np.maximum(s2 - s1 * mean, 0) / (n - ddof)
+    mean = mean + ref
+    std = np.sqrt(var)
+    mean[n < max(min_periods, 1)] = np.nan
+    std[(n < min_periods) | (n <= ddof)] = np.nan
+    return mean, std
+
+
+class _WindowBounds(BaseIndexer):
+    """Hands precomputed window bounds to the pandas rolling aggregations."""
+
+    def get_window_bounds(self, num_values=0, min_periods=None, center=None,
+                          closed=None, step=None):
+        return self.start, self.end
+
+
+def _rolling_order_statistic(t, X, window, min_periods, statistic):
+    """Applies a pandas order statistic (median or max) over the centered windows.
+    These keep a sorted structure of the window (a skiplist for the median and a
+    monotonic deque for the max) that is updated as the window slides, which is
+    faster than any array-at-a-time formulation."""
+    X = _prep_values(X)
+    start, end = window_bounds(t, window)
+    indexer = _WindowBounds(start=start.astype(np.int64), end=end.astype(np.int64))
+    frame = pd.DataFrame(X.reshape(-1, X.shape[-1]).T)
+    rolled = frame.rolling(indexer, min_periods=max(min_periods, 1))
+    return getattr(rolled, statistic)().values.T.reshape(X.shape)
+
+
+def rolling_median(t, X, window, min_periods=1):
+    """Rolling median over centered time windows."""
+    return _rolling_order_statistic(t, X, window, min_periods, 'median')
+
+
+def rolling_max(t, X, window, min_periods=1):
+    """Rolling maximum over centered time windows."""
+    return _rolling_order_statistic(t, X, window, min_periods, 'max')
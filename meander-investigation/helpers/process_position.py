@@ -18,6 +18,10 @@ def get_frequency(buoy_df, warning=False):
     if (np.abs(f - fmax) > 0) | (np.abs(f - fmin) > 0) and warning:
        print('Warning: buoy has varying frequency. fmin=', fmin, 'fmax=', fmax, 'f=', f)
         
+    return _interp_freq(f)
+
+def _interp_freq(f):
+    """Interpolation frequency for a median sampling interval of f minutes."""
     if f <= 30:
         interp_freq = '30min'
     elif f <= 65: # There's a couple that are at 61, which is certainly an error (either human or computer)
@@ -28,6 +32,15 @@ def get_frequency(buoy_df, warning=False):
 
     return interp_freq
 
+def get_frequencies(loc_df, buoy_col="BuoyID"):
+    """get_frequency for every buoy of a long-format dataframe with a time index,
+    grouped by buoy and sorted by time. Returns a Series indexed by buoy."""
+    buoy = loc_df[buoy_col].values
+    t = loc_df.index.to_series()
+    dt = (t - t.shift(1)).where(buoy == np.roll(buoy, 1))
+    f = np.round(dt.dt.total_seconds().groupby(buoy, sort=False).median() / 60, 0)
+    return f.dropna().astype(int).map(_interp_freq)
+
 def clean_location_df(loc_df):
     buoy = loc_df["BuoyID"]
 
@@ -64,4 +77,35 @@ def clean_location_df(loc_df):
         
         return df
     
-    return None
\ No newline at end of file
+    return None
+
+def clean_location_frame(loc_df, buoy_col="BuoyID"):
+    """Batched version of clean_location_df for a long-format dataframe with the
+    data of all buoys, e.g. an IABP L1 year file with a time index, grouped by buoy
+    and sorted by time. The frequencies of all buoys are found at once with
+    get_frequencies, and the QC runs for all buoys in a single call to
+    standard_qc_batch. Returns a dictionary with the interpolated track of each
+    buoy that passed QC."""
+
+    freq = get_frequencies(loc_df, buoy_col)
+    minutes = freq.str.replace('min', '').astype(int)
+    loc_df = loc_df.loc[loc_df[buoy_col].isin(freq.index)]
+
+    df_qc = cleaning.standard_qc_batch(loc_df,
+                        buoy_col=buoy_col,
+                        min_size=100,
+                        gap_threshold=pd.to_timedelta(minutes * 3, unit='min'),
+                        segment_length=24,
+                        lon_range=(-180, 180),
+                        lat_range=(50, 90),
+                        max_speed=1.5,
+                        speed_window='3D',
+                        verbose=False)
+
+    clean = {}
+    for buoy, df in df_qc[df_qc["flag"] == False].groupby(buoy_col, sort=False):
+        maxgap = 4 * minutes[buoy]
+        clean[buoy] = interpolation.interpolate_buoy_track(df.drop(columns=['flag', 'qc_mask']),
+                                                xvar='longitude', yvar='latitude', 
+                                                freq=freq[buoy], maxgap_minutes=max(maxgap, 120))
+    return clean
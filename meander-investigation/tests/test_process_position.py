@@ -0,0 +1,60 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+# The meander notebooks run from meander-investigation with the vendored icedrift
+# package in helpers importable as icedrift
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(HERE), os.path.join(os.path.dirname(HERE), 'helpers')]
+
+from helpers import process_position
+
+
+def make_frame(buoys=('A', 'B'), n=400, freq='60min'):
+    """Random walk tracks, with position spikes in every buoy and, in the second
+    buoy, a gap that leaves a segment too short to keep."""
+    frames = []
+    for k, buoy in enumerate(buoys):
+        rng = np.random.default_rng(k)
+        t = pd.date_range('2020-01-01', periods=n, freq=freq)
+        df = pd.DataFrame({'BuoyID': buoy,
+                           'latitude': 80 + np.cumsum(rng.standard_normal(n))*0.002,
+                           'longitude': 10 + k + np.cumsum(rng.standard_normal(n))*0.01},
+                          index=pd.DatetimeIndex(t, name='datetime'))
+        spikes = rng.choice(np.arange(20, n - 20), size=n // 100, replace=False)
+        df.iloc[spikes, 1] += 0.2
+        if k == 1:
+            df = df.drop(df.index[200:210]).drop(df.index[220:230])
+        frames.append(df)
+    return pd.concat(frames)
+
+
+def test_uses_vendored_cleaning():
+    path = os.path.join('helpers', 'icedrift', 'cleaning.py')
+    assert process_position.cleaning.__file__.endswith(path)
+
+
+def test_clean_location_frame():
+    # The batched QC against the vendored per-buoy standard_qc, which drops the
+    # rows that fail each check in turn
+    data = make_frame()
+    short = make_frame(buoys=('C',), n=50)
+    clean = process_position.clean_location_frame(pd.concat([data, short]))
+    assert sorted(clean) == ['A', 'B']
+    for buoy, df in data.groupby('BuoyID'):
+        qc = process_position.cleaning.standard_qc(df, min_size=100, gap_threshold='180min',
+                                                   lat_range=(50, 90))
+        assert len(qc) <= len(df) - len(df) // 100
+        expected = process_position.interpolation.interpolate_buoy_track(
+            qc, xvar='longitude', yvar='latitude', freq='60min', maxgap_minutes=240)
+        pd.testing.assert_frame_equal(clean[buoy], expected)
+
+
+def test_standard_qc_batch_flags():
+    data = make_frame()
+    flagged = process_position.cleaning.standard_qc_batch(data, lat_range=(50, 90))
+    for buoy, df in data.groupby('BuoyID'):
+        qc = process_position.cleaning.standard_qc(df, lat_range=(50, 90))
+        kept = flagged.loc[flagged['BuoyID'] == buoy]
+        pd.testing.assert_index_equal(kept.index[~kept['flag']], qc.index)
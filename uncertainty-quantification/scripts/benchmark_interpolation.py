@@ -0,0 +1,23 @@
+"""Compares the interpolation methods in icedrift.interpolation.INTERPOLATORS on the
+quality controlled buoy tracks. A share of the fixes of each buoy is held out and
+predicted from the others; the summary lists the median RMS position error, time and
+memory of each method for each class of sampling interval, so that the cheapest
+method within the error budget can be chosen.
+"""
+from helpers import *
+from icedrift.interpolation import benchmark_interpolators
+
+metadata = buoy_metadata()
+valid = list(metadata[metadata["Interp"] == True].index)
+
+data = {}
+for buoy in valid:
+    buoy_df = buoy_data(buoy, version="qc").set_index("datetime")
+    data[buoy] = buoy_df
+
+results = benchmark_interpolators(data, holdout=0.1)
+results.to_csv("../data/metadata/interpolation_benchmark.csv", index=False)
+
+summary = results.groupby(["frequency_class", "method"])[["rms_error_m", "time_s", "peak_memory_kb"]].median()
+summary["n_buoys"] = results.groupby(["frequency_class", "method"])["buoy"].count()
+summary.to_csv("../data/metadata/interpolation_benchmark_summary.csv")
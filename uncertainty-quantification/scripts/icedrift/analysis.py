@@ -4,7 +4,8 @@
 
 import pandas as pd
 import numpy as np
-import pyproj
+import xarray as xr
+from icedrift.projection import add_xy, project, unproject
 
     
 def compute_velocity(buoy_df, date_index=True, rotate_uv=False, method='c'):
@@ -31,63 +32,21 @@ def compute_velocity(buoy_df, date_index=True, rotate_uv=False, method='c'):
     buoy_df = buoy_df.copy()
     
     if date_index:
-        date = pd.Series(pd.to_datetime(buoy_df.index.values), index=pd.to_datetime(buoy_df.index))
+        t = pd.to_datetime(buoy_df.index.values)
     else:
-        date = pd.to_datetime(buoy_df.date)
-        
-    delta_t_next = date.shift(-1) - date
-    delta_t_prior = date - date.shift(1)
-    min_dt = pd.DataFrame({'dtp': delta_t_prior, 'dtn': delta_t_next}).min(axis=1)
-
-    # bwd endpoint means the next expected obs is missing: last data before gap
-    bwd_endpoint = (delta_t_prior < delta_t_next) & (np.abs(delta_t_prior - delta_t_next) > 2*min_dt)
-    fwd_endpoint = (delta_t_prior > delta_t_next) & (np.abs(delta_t_prior - delta_t_next) > 2*min_dt)
+        t = pd.to_datetime(buoy_df.date)
     
     if 'x' not in buoy_df.columns:
-        projIn = 'epsg:4326' # WGS 84 Ellipsoid
-        projOut = 'epsg:3413' # NSIDC North Polar Stereographic
-        transformer = pyproj.Transformer.from_crs(projIn, projOut, always_xy=True)
-
-        lon = buoy_df.longitude.values
-        lat = buoy_df.latitude.values
-
-        x, y = transformer.transform(lon, lat)
-        buoy_df['x'] = x
-        buoy_df['y'] = y
-    
-    if method in ['f', 'forward']:
-        dt = (date.shift(-1) - date).dt.total_seconds().values
-        dxdt = (buoy_df['x'].shift(-1) - buoy_df['x'])/dt
-        dydt = (buoy_df['y'].shift(-1) - buoy_df['y'])/dt
-
-    elif method in ['b', 'backward']:
-        dt = (date - date.shift(1)).dt.total_seconds()
-        dxdt = (buoy_df['x'] - buoy_df['x'].shift(1))/dt
-        dydt = (buoy_df['y'] - buoy_df['y'].shift(1))/dt
-
-    elif method in ['c', 'fb', 'bf', 'centered', 'forward_backward']:
-        fwd_df = compute_velocity(buoy_df.copy(), date_index=date_index, method='forward')
-        bwd_df = compute_velocity(buoy_df.copy(), date_index=date_index, method='backward')
-
-        fwd_dxdt, fwd_dydt = fwd_df['u'], fwd_df['v']
-        bwd_dxdt, bwd_dydt = bwd_df['u'], bwd_df['v']
-        
-        if method in ['c', 'centered']:
-            dt = (date.shift(-1) - date.shift(1)).dt.total_seconds()
-            dxdt = (buoy_df['x'].shift(-1) - buoy_df['x'].shift(1))/dt
-            dydt = (buoy_df['y'].shift(-1) - buoy_df['y'].shift(1))/dt
-        elif method in ['fb', 'bf', 'forward_backward']:
-            dxdt = np.sign(bwd_dxdt)*np.abs(pd.DataFrame({'f': fwd_dxdt, 'b':bwd_dxdt})).min(axis=1)
-            dydt = np.sign(bwd_dydt)*np.abs(pd.DataFrame({'f': fwd_dydt, 'b':bwd_dydt})).min(axis=1)
-        else:
-            print('Unrecognized method')
-
-        dxdt.loc[fwd_endpoint] = fwd_dxdt.loc[fwd_endpoint]
-        dxdt.loc[bwd_endpoint] = bwd_dxdt.loc[bwd_endpoint]
-        dydt.loc[fwd_endpoint] = fwd_dydt.loc[fwd_endpoint]
-        dydt.loc[bwd_endpoint] = bwd_dydt.loc[bwd_endpoint]
-    else:
-        print('Method must be one of f, forward, b, backward, c, centered, fb, forward_backward, method supplied was', method) 
+        # NSIDC North Polar Stereographic
+        add_xy(buoy_df, 'epsg:3413')
+
+    if method not in VELOCITY_METHODS:
+        print('Method must be one of f, forward, b, backward, c, centered, fb, forward_backward, method supplied was', method)
+        raise ValueError('Unrecognized method ' + str(method))
+    dxdt, dydt = velocity_kernel(pd.DatetimeIndex(t).asi8, buoy_df['x'].values, buoy_df['y'].values,
+                                 methods=[method])[VELOCITY_METHODS[method]]
+    dxdt = pd.Series(dxdt, index=buoy_df.index)
+    dydt = pd.Series(dydt, index=buoy_df.index)
     
     if rotate_uv:
         # Unit vectors
@@ -118,10 +77,82 @@ def compute_velocity(buoy_df, date_index=True, rotate_uv=False, method='c'):
     return buoy_df
 
 
+# Names accepted by compute_velocity and velocity_kernel for each method
+VELOCITY_METHODS = {'f': 'f', 'forward': 'f', 'b': 'b', 'backward': 'b',
+                    'c': 'c', 'centered': 'c',
+                    'fb': 'fb', 'bf': 'fb', 'forward_backward': 'fb'}
+
+def velocity_kernel(t, x, y, methods=('f', 'b', 'c', 'fb')):
+    """Array version of compute_velocity. Computes the velocity for each of <methods>
+    from int64 times <t> in nanoseconds and positions <x> and <y> in meters, sharing
+    the time steps and differences between the methods. <x> and <y> can have leading
+    dimensions before the time axis. Returns a dictionary with the short method
+    names ('f', 'b', 'c', 'fb') as keys and (u, v) arrays as values.
+
+    As in compute_velocity, the centered and forward-backward velocities switch to
+    forward (backward) differences at the first (last) point after (before) a gap,
+    i.e. where the time steps on the two sides differ by more than twice the
+    shorter one.
+    """
+    methods = set(VELOCITY_METHODS[m] for m in methods)
+    t = np.asarray(t, dtype=np.int64)
+    X = np.stack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)])
+    n = len(t)
+
+    dt = np.diff(t).astype(float) / 1e9
+    dX = np.diff(X, axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        step = dX / dt
+    # Forward and backward differences, NaN where there is no neighbor
+    edge = np.full(X.shape[:-1] + (1,), np.nan)
+    fwd = np.concatenate([step, edge], axis=-1)
+    bwd = np.concatenate([edge, step], axis=-1)
+
+    result = {}
+    if 'f' in methods:
+        result['f'] = (fwd[0], fwd[1])
+    if 'b' in methods:
+        result['b'] = (bwd[0], bwd[1])
+    if 'c' in methods or 'fb' in methods:
+        dtn = np.append(dt, np.nan)
+        dtp = np.insert(dt, 0, np.nan)
+        with np.errstate(invalid='ignore'):
+            min_dt = np.fmin(dtp, dtn)
+            # bwd endpoint means the next expected obs is missing: last data before gap
+            bwd_endpoint = (dtp < dtn) & (np.abs(dtp - dtn) > 2*min_dt)
+            fwd_endpoint = (dtp > dtn) & (np.abs(dtp - dtn) > 2*min_dt)
+
+        for method in methods & {'c', 'fb'}:
+            if method == 'c':
+                U = np.full(X.shape, np.nan)
+                if n > 2:
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        U[..., 1:-1] = (X[..., 2:] - X[..., :-2]) / ((t[2:] - t[:-2]) / 1e9)
+            else:
+                U = np.sign(bwd) * np.fmin(np.abs(fwd), np.abs(bwd))
+            U = np.where(fwd_endpoint, fwd, U)
+            U = np.where(bwd_endpoint, bwd, U)
+            result[method] = (U[0], U[1])
+    return result
+
+
+def grid_velocity(t, X, Y):
+    """Centered difference velocities of tracks aligned on a common regular time axis,
+    e.g. the rows of a track cube (see interpolation.build_track_cube). <t> are the
+    int64 times in nanoseconds, and <X> and <Y> the positions in meters with time
+    along the last axis and NaN where a buoy has no position. The result is the same
+    as compute_velocity(method='c') on the aligned rows, as used in
+    compute_strain_rate_components: NaN at the first and last time and next to
+    missing positions."""
+    return velocity_kernel(t, X, Y, methods=['c'])['c']
+
+
 def compute_absolute_dispersion(vel_varname, data, max_length='30D', step_size=3600):
     """Computes the absolute dispersion for buoys in data. Data need
     to be aligned to a common time step. Assumes the start time is time 0,
     and will use data up to time 0 + max_length. Step size in seconds.
+    See dispersion.absolute_dispersion for a version that removes the mean
+    drift and gives confidence intervals.
     """
     dt = pd.to_timedelta(max_length)
     vel_df = pd.DataFrame({b: data[b][vel_varname].loc[
@@ -192,70 +223,6 @@ def compute_strain_rate_components(buoys, data,
         # TBD!
         return False
 
-    def polygon_area(X, Y):
-        """Compute area of polygon as a sum. Use LAEA not PS here"""
-        sumvar = 0.
-        N = len(X)        
-        for i in range(N):
-            sumvar += X[i]*Y[(i+1) % N] - Y[i]*X[(i+1) % N]
-        return sumvar*0.5
-    
-    def polygon_area_uncertainty(X, Y, position_uncertainty):
-        """Compute the area uncertainty following Dierking et al. 2020"""
-        N = len(X)
-        S = 0
-        for i in range(N):
-            S += (X[(i+1) % N] - X[(i-1) % N])**2 + \
-                 (Y[(i+1) % N] - Y[(i-1) % N])**2
-        return np.sqrt(0.25*position_uncertainty**2*S)
-
-    def gradvel_uncertainty(X, Y, U, V, A, position_uncertainty,
-                            time_delta, vel_var='u', x_var='x'):
-        """Equation 19 from Dierking et al. 2020 assuming uncertainty 
-        in position is same in both x and y. Also assuming that there
-        is no uncertainty in time. Default returns standard deviation
-        uncertainty for dudx.
-        """
-        sigma_A = polygon_area_uncertainty(X, Y, position_uncertainty)
-        sigma_X = position_uncertainty
-        
-        # velocity uncertainty
-        if vel_var=='u':
-            u = U.copy()
-        else:
-            u = V.copy()
-        if x_var == 'x':
-            # To get dudx, integrate over Y
-            x = Y.copy()
-        else:
-            x = X.copy()
-        
-        sigma_U = 2*sigma_X**2/time_delta**2
-        
-        N = len(X)
-        S1, S2, S3 = 0, 0, 0
-        for i in range(N):
-            # the modulus here makes the calculation wrap around to the beginning
-            S1 += (u[(i+1) % N] + u[(i-1) % N])**2 * \
-                  (x[(i+1) % N] - x[(i-1) % N])**2
-            S2 += (x[(i+1) % N] - x[(i-1) % N])**2
-            S3 += (u[(i+1) % N] + u[(i-1) % N])**2
-            
-        var_ux = sigma_A**2/(4*A**4)*S1 + \
-                 sigma_U**2/(4*A**2)*S2 + \
-                 sigma_X**2/(4*A**2)*S3
-
-        return np.sqrt(var_ux)
-
-    def accel(X, U, A, sign):
-        """Computes spatial derivative of velocity for 
-        deformation."""
-        N = len(X)
-        sumvar = 0
-        for i in range(N):
-            sumvar += (U[(i+1) % N] + U[i])*(X[(i+1) % N] - X[i])
-        return 1/(2*A) * sumvar * sign
-
     lon_data = pd.DataFrame({b: data[b]['longitude'] for b in buoys})
     lat_data = pd.DataFrame({b: data[b]['latitude'] for b in buoys})
     time_delta = pd.to_timedelta(time_delta).total_seconds()
@@ -264,12 +231,8 @@ def compute_strain_rate_components(buoys, data,
     # Potential improvement: use a local stereographic projection 
     # instead of the North Polar stereographic
     
-    projIn = 'epsg:4326' # WGS 84 Ellipsoid
-    projOut = 'epsg:3413' # NSIDC North Polar Stereographic
-    transformer_ps = pyproj.Transformer.from_crs(projIn, projOut, always_xy=True)
-
-    projOut = 'epsg:6931' # NSIDC EASE 2.0 (for area calculation)
-    transformer_laea = pyproj.Transformer.from_crs(projIn, projOut, always_xy=True)
+    proj_ps = 'epsg:3413' # NSIDC North Polar Stereographic
+    proj_laea = 'epsg:6931' # NSIDC EASE 2.0 (for area calculation)
 
     # Initialize the dataframes for position data
     # X, Y, U, and V are in polar stereographic coordinates
@@ -286,11 +249,11 @@ def compute_strain_rate_components(buoys, data,
         lon = lon_data[buoy].values
         lat = lat_data[buoy].values
 
-        x, y = transformer_ps.transform(lon, lat)
+        x, y = project(lon, lat, proj_ps)
         X_data[buoy] = x
         Y_data[buoy] = y
         
-        xa, ya = transformer_laea.transform(lon, lat)
+        xa, ya = project(lon, lat, proj_laea)
         XA_data[buoy] = xa
         YA_data[buoy] = ya
         
@@ -310,61 +273,30 @@ def compute_strain_rate_components(buoys, data,
     U = U_data.T.values
     V = V_data.T.values
 
-    A = polygon_area(XA, YA)
+    strain = strain_rate_arrays(X, Y, XA, YA, U, V, position_uncertainty, time_delta)
 
     # Check order of points
     # Can't handle reversal partway through though!
-    if np.all(A[~np.isnan(A)] < 0):
+    if strain['reversed']:
         print('Reversing order')
-        X = X[::-1,:]
-        XA = XA[::-1,:]
-        Y = Y[::-1,:]
-        YA = YA[::-1,:]
-        U = U[::-1,:]
-        V = V[::-1,:]
-        
-    if np.any(A[~np.isnan(A)] < 0) & np.any(A[~np.isnan(A)] > 0):
+    if strain['sign_reverses']:
         print('Warning! Sign of area reverses')
-        
-    A = polygon_area(XA, YA)
 
-    dudx = accel(Y, U, A, 1)
-    dudy = accel(X, U, A, -1)
-    dvdx = accel(Y, V, A, 1)
-    dvdy = accel(X, V, A, -1)
-
-    # After getting the gradients, we can calculate the strain rate components
-    divergence = dudx + dvdy
-    vorticity = dvdx - dudy
-    pure_shear = dudy + dvdx
-    normal_shear = dudx - dvdy
-    maximum_shear_strain_rate = np.sqrt(pure_shear**2 + normal_shear**2)
-    total_deformation = np.sqrt(divergence**2 + maximum_shear_strain_rate**2)
-
-    # Finally we calculate the uncertainty in each component
-    sigma_A = polygon_area_uncertainty(X, Y, position_uncertainty)
-    sigma_dudx = gradvel_uncertainty(X, Y, U, V, A,
-                                     position_uncertainty,
-                                     time_delta, vel_var='u', x_var='x')
-    sigma_dvdx = gradvel_uncertainty(X, Y, U, V, A,
-                                     position_uncertainty,
-                                     time_delta, vel_var='v', x_var='x')
-    sigma_dudy = gradvel_uncertainty(X, Y, U, V, A,
-                                     position_uncertainty,
-                                     time_delta, vel_var='u', x_var='y')
-    sigma_dvdy = gradvel_uncertainty(X, Y, U, V, A,
-                                     position_uncertainty,
-                                     time_delta, vel_var='v', x_var='y')
-
-    sigma_div = np.sqrt(sigma_dudx**2 + sigma_dvdy**2)
-    sigma_vrt = np.sqrt(sigma_dvdx**2 + sigma_dudy**2)
-    sigma_shr = np.sqrt((normal_shear/maximum_shear_strain_rate)**2 * \
-                        (sigma_dudx**2 + sigma_dvdy**2) + \
-                        (pure_shear/maximum_shear_strain_rate)**2 * \
-                        (sigma_dudy**2 + sigma_dvdx**2))
-    sigma_tot = np.sqrt((maximum_shear_strain_rate/total_deformation)**2 * \
-                        sigma_shr**2 + \
-                        (divergence/total_deformation)**2 * sigma_vrt**2)
+    divergence = strain['divergence']
+    vorticity = strain['vorticity']
+    pure_shear = strain['pure_shear']
+    normal_shear = strain['normal_shear']
+    maximum_shear_strain_rate = strain['maximum_shear_strain_rate']
+    total_deformation = strain['total_deformation']
+    dudx, dudy, dvdx, dvdy = strain['dudx'], strain['dudy'], strain['dvdx'], strain['dvdy']
+    A = strain['area']
+    sigma_A = strain['uncertainty_area']
+    sigma_div = strain['uncertainty_divergence']
+    sigma_vrt = strain['uncertainty_vorticity']
+    sigma_shr = strain['uncertainty_shear']
+    sigma_tot = strain['uncertainty_total']
+    sigma_dudx, sigma_dudy = strain['uncertainty_dudx'], strain['uncertainty_dudy']
+    sigma_dvdx, sigma_dvdy = strain['uncertainty_dvdx'], strain['uncertainty_dvdy']
     
     # Results are arranged in a dataframe
     if verbose:
@@ -406,4 +338,364 @@ def compute_strain_rate_components(buoys, data,
              'uncertainty_shear': sigma_shr,
              'uncertainty_total': sigma_tot,
              'shape_flag': np.sign(A)},
-            index=X_data.index)
\ No newline at end of file
+            index=X_data.index)
+
+
+def _vertex_neighbors(a):
+    """Values at the next and at the previous vertex of polygon arrays with the
+    vertices along axis -2, wrapping around at the ends."""
+    return np.roll(a, -1, axis=-2), np.roll(a, 1, axis=-2)
+
+
+def strain_rate_arrays(X, Y, XA, YA, U, V, position_uncertainty=10, time_delta=3600,
+                       uncertainty=True):
+    """Array core of compute_strain_rate_components. Inputs have shape
+    (..., vertex, time), e.g. (polygon, vertex, time) for many polygons with the same
+    number of vertices: X, Y, U, V in polar stereographic coordinates and XA, YA in
+    Lambert Azimuthal Equal Area coordinates for the area. The sums over the polygon
+    edges are taken along the vertex axis with np.roll. time_delta in seconds.
+
+    Returns a dictionary of arrays of shape (..., time) with the strain rate
+    components, velocity gradients, area and their uncertainties (keys as in the
+    verbose output of compute_strain_rate_components, with dudx etc. for the mean
+    gradients), plus the arrays of shape (...) 'reversed', True for polygons whose
+    vertices are in clockwise order at all times (their area is reported as
+    positive), and 'sign_reverses', True where the sign of the area changes. With
+    uncertainty=False the uncertainties are left out.
+    """
+    X_next, X_prior = _vertex_neighbors(X)
+    Y_next, Y_prior = _vertex_neighbors(Y)
+
+    def polygon_area(X, Y):
+        """Compute area of polygon as a sum. Use LAEA not PS here"""
+        X_next, Y_next = np.roll(X, -1, axis=-2), np.roll(Y, -1, axis=-2)
+        return 0.5 * np.sum(X*Y_next - Y*X_next, axis=-2)
+
+    # Area uncertainty following Dierking et al. 2020
+    S = np.sum((X_next - X_prior)**2 + (Y_next - Y_prior)**2, axis=-2)
+    sigma_A = np.sqrt(0.25*position_uncertainty**2*S)
+
+    def gradvel_uncertainty(u, x, A):
+        """Equation 19 from Dierking et al. 2020 assuming uncertainty 
+        in position is same in both x and y. Also assuming that there
+        is no uncertainty in time. To get dudx, integrate u over Y.
+        """
+        sigma_X = position_uncertainty
+        sigma_U = 2*sigma_X**2/time_delta**2
+        u_next, u_prior = _vertex_neighbors(u)
+        x_next, x_prior = _vertex_neighbors(x)
+        S1 = np.sum((u_next + u_prior)**2 * (x_next - x_prior)**2, axis=-2)
+        S2 = np.sum((x_next - x_prior)**2, axis=-2)
+        S3 = np.sum((u_next + u_prior)**2, axis=-2)
+        var_ux = sigma_A**2/(4*A**4)*S1 + \
+                 sigma_U**2/(4*A**2)*S2 + \
+                 sigma_X**2/(4*A**2)*S3
+        return np.sqrt(var_ux)
+
+    def accel(X, U, A, sign):
+        """Computes spatial derivative of velocity for 
+        deformation."""
+        sumvar = np.sum((np.roll(U, -1, axis=-2) + U)*(np.roll(X, -1, axis=-2) - X), axis=-2)
+        return 1/(2*A) * sumvar * sign
+
+    A = polygon_area(XA, YA)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dudx = accel(Y, U, A, 1)
+        dudy = accel(X, U, A, -1)
+        dvdx = accel(Y, V, A, 1)
+        dvdy = accel(X, V, A, -1)
+
+        # After getting the gradients, we can calculate the strain rate components
+        divergence = dudx + dvdy
+        vorticity = dvdx - dudy
+        pure_shear = dudy + dvdx
+        normal_shear = dudx - dvdy
+        maximum_shear_strain_rate = np.sqrt(pure_shear**2 + normal_shear**2)
+        total_deformation = np.sqrt(divergence**2 + maximum_shear_strain_rate**2)
+
+    # Clockwise polygons: reversing the vertices changes the sign of both the area and
+    # the line integrals, so the gradients above are the same and only the area flips
+    valid = ~np.isnan(A)
+    negative = np.any(valid & (A < 0), axis=-1)
+    positive = np.any(valid & (A > 0), axis=-1)
+    reversed_order = negative & ~positive
+    A = np.where(reversed_order[..., None], -A, A)
+
+    result = {'divergence': divergence,
+              'vorticity': vorticity,
+              'pure_shear': pure_shear,
+              'normal_shear': normal_shear,
+              'maximum_shear_strain_rate': maximum_shear_strain_rate,
+              'total_deformation': total_deformation,
+              'dudx': dudx,
+              'dudy': dudy,
+              'dvdx': dvdx,
+              'dvdy': dvdy,
+              'area': A,
+              'reversed': reversed_order,
+              'sign_reverses': negative & positive}
+    if not uncertainty:
+        return result
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Finally we calculate the uncertainty in each component
+        sigma_dudx = gradvel_uncertainty(U, Y, A)
+        sigma_dvdx = gradvel_uncertainty(V, Y, A)
+        sigma_dudy = gradvel_uncertainty(U, X, A)
+        sigma_dvdy = gradvel_uncertainty(V, X, A)
+
+        sigma_div = np.sqrt(sigma_dudx**2 + sigma_dvdy**2)
+        sigma_vrt = np.sqrt(sigma_dvdx**2 + sigma_dudy**2)
+        sigma_shr = np.sqrt((normal_shear/maximum_shear_strain_rate)**2 * \
+                            (sigma_dudx**2 + sigma_dvdy**2) + \
+                            (pure_shear/maximum_shear_strain_rate)**2 * \
+                            (sigma_dudy**2 + sigma_dvdx**2))
+        sigma_tot = np.sqrt((maximum_shear_strain_rate/total_deformation)**2 * \
+                            sigma_shr**2 + \
+                            (divergence/total_deformation)**2 * sigma_vrt**2)
+
+    result.update({'uncertainty_area': sigma_A,
+                   'uncertainty_divergence': sigma_div,
+                   'uncertainty_vorticity': sigma_vrt,
+                   'uncertainty_shear': sigma_shr,
+                   'uncertainty_total': sigma_tot,
+                   'uncertainty_dudx': sigma_dudx,
+                   'uncertainty_dudy': sigma_dudy,
+                   'uncertainty_dvdx': sigma_dvdx,
+                   'uncertainty_dvdy': sigma_dvdy})
+    return result
+
+
+def cube_kinematics(cube):
+    """Positions and velocities of the buoys in the track cube <cube> (see
+    interpolation.build_track_cube) as used for strain rates. Returns the (buoy, time)
+    arrays X, Y (polar stereographic), XA, YA (Lambert Azimuthal Equal Area) and the
+    centered difference velocities U, V from grid_velocity, which also gives the u
+    and v of the cube."""
+    time = pd.DatetimeIndex(cube['time'].values)
+    lon = cube['longitude'].values
+    lat = cube['latitude'].values
+    X, Y = [a.reshape(lon.shape) for a in project(lon.ravel(), lat.ravel(), 'epsg:3413')]
+    XA, YA = [a.reshape(lon.shape) for a in project(lon.ravel(), lat.ravel(), 'epsg:6931')]
+    U, V = grid_velocity(time.asi8, X, Y)
+    return X, Y, XA, YA, U, V
+
+
+# Variables of compute_strain_rate_batch, and the additional ones with verbose=True
+STRAIN_VARIABLES = ['divergence', 'vorticity', 'pure_shear', 'normal_shear',
+                    'maximum_shear_strain_rate', 'total_deformation', 'area',
+                    'uncertainty_area', 'uncertainty_divergence', 'uncertainty_vorticity',
+                    'uncertainty_shear', 'uncertainty_total']
+STRAIN_VERBOSE_VARIABLES = ['dudx', 'dudy', 'dvdx', 'dvdy', 'uncertainty_dudx',
+                            'uncertainty_dudy', 'uncertainty_dvdx', 'uncertainty_dvdy']
+
+def compute_strain_rate_batch(polygons, cube, position_uncertainty=10, time_delta=None,
+                              chunk_size=1000, verbose=False, valid=None):
+    """Batched compute_strain_rate_components for many polygons of buoys in the track
+    cube <cube> (see interpolation.build_track_cube), given as a list of lists of
+    buoy labels. Positions are projected and velocities computed (centered
+    differences, as in compute_strain_rate_components) once per buoy, then gathered
+    into (polygon, vertex, time) arrays for all polygons with the same number of
+    vertices and passed to strain_rate_arrays, <chunk_size> polygons at a time.
+    time_delta defaults to the time step of the cube.
+
+    <valid> is an optional (polygon, time) boolean mask, e.g. the 'valid' variable of
+    shape.screen_polygons. Polygons that are never valid are skipped, and results
+    are NaN where the mask is False.
+
+    Returns an xarray Dataset with dimensions (polygon, time) holding the variables
+    in STRAIN_VARIABLES (and STRAIN_VERBOSE_VARIABLES if verbose) and shape_flag, and
+    the coordinate 'vertices' with the buoys of each polygon joined by '-'.
+    """
+    buoys = list(cube['buoy'].values)
+    time = pd.DatetimeIndex(cube['time'].values)
+    if time_delta is None:
+        time_delta = (time[1] - time[0]).total_seconds() if len(time) > 1 else 3600.
+    else:
+        time_delta = pd.to_timedelta(time_delta).total_seconds()
+    X, Y, XA, YA, U, V = cube_kinematics(cube)
+
+    position = {b: i for i, b in enumerate(buoys)}
+    variables = STRAIN_VARIABLES + (STRAIN_VERBOSE_VARIABLES if verbose else [])
+    out = {var: np.full((len(polygons), len(time)), np.nan) for var in variables}
+    sizes = np.array([len(p) for p in polygons])
+    if valid is not None:
+        valid = np.asarray(valid, dtype=bool)
+    for n in np.unique(sizes):
+        rows = np.flatnonzero(sizes == n)
+        if valid is not None:
+            rows = rows[valid[rows].any(axis=1)]
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            idx = np.array([[position[b] for b in polygons[k]] for k in chunk])
+            strain = strain_rate_arrays(X[idx], Y[idx], XA[idx], YA[idx], U[idx], V[idx],
+                                        position_uncertainty, time_delta)
+            for var in variables:
+                out[var][chunk] = strain[var] if valid is None else \
+                    np.where(valid[chunk], strain[var], np.nan)
+
+    data = {var: (('polygon', 'time'), out[var]) for var in variables}
+    data['shape_flag'] = (('polygon', 'time'), np.sign(out['area']))
+    vertices = ['-'.join(str(b) for b in p) for p in polygons]
+    return xr.Dataset(data, coords={'polygon': np.arange(len(polygons)), 'time': time,
+                                    'vertices': ('polygon', vertices)})
+
+
+# Components summarized by strain_rate_ensemble
+ENSEMBLE_VARIABLES = ['divergence', 'vorticity', 'pure_shear', 'normal_shear',
+                      'maximum_shear_strain_rate', 'total_deformation', 'area']
+
+def _position_sigma(position_uncertainty, cube):
+    """Position uncertainty in meters as a (buoy, time) array. Accepts a number, a
+    dictionary by buoy, an array of shape (buoy,) or (buoy, time), or the name of a
+    variable of the cube."""
+    shape = (cube.sizes['buoy'], cube.sizes['time'])
+    if isinstance(position_uncertainty, str):
+        sigma = cube[position_uncertainty].values
+    elif isinstance(position_uncertainty, dict):
+        sigma = np.array([position_uncertainty[b] for b in cube['buoy'].values], dtype=float)
+    else:
+        sigma = np.asarray(position_uncertainty, dtype=float)
+    if sigma.ndim == 1:
+        sigma = sigma[:, None]
+    return np.broadcast_to(sigma, shape)
+
+
+def strain_rate_ensemble(polygons, cube, n_members=100, position_uncertainty=10,
+                         quantiles=(0.05, 0.5, 0.95), max_memory_mb=512, seed=0):
+    """Monte Carlo uncertainty of the strain rates of polygons of buoys in the track
+    cube <cube>, as an alternative to the linearized uncertainties of
+    strain_rate_arrays, which do not hold for small or thin polygons.
+
+    Each of the n_members (at least 2) ensemble members adds Gaussian noise with
+    standard deviation <position_uncertainty> (meters, in each direction)
+    independently to every buoy position. The noise of each member is drawn for all
+    buoys and time steps in one call to a random generator seeded with (seed,
+    member), so a buoy gets the same noise in every polygon it belongs to, and the
+    results do not depend on how polygons and members are split up. The uncertainty
+    can be a number, a dictionary by buoy (e.g. the median sigma_x_regrid of each buoy from
+    interpolation.regrid_buoy_track), an array of shape (buoy,) or (buoy, time), or
+    the name of a variable of the cube. Positions in the equal area projection are
+    perturbed with the local linear map from the polar stereographic coordinates.
+    Velocities of the unperturbed and perturbed positions are both computed with
+    grid_velocity on the times of the cube. The areas of the members are positive
+    or negative like the area of the unperturbed polygon.
+
+    To stay within about <max_memory_mb> on top of arrays the size of the cube,
+    polygons (and time steps, if a single polygon does not fit) are processed in
+    chunks whose ensemble results fit in a quarter of it, and the members of a chunk
+    in blocks, with strain_rate_arrays evaluated for all members of a block at once.
+
+    Returns an xarray Dataset with dimensions (polygon, time) holding for each
+    component in ENSEMBLE_VARIABLES the unperturbed value, the linearized
+    uncertainty_<component> (for components that have one, using the mean position
+    uncertainty and the median time step), the ensemble mean_<component> and
+    std_<component>, and quantile_<component> with the extra dimension quantile.
+    """
+    if n_members < 2:
+        raise ValueError('strain_rate_ensemble needs n_members >= 2, got ' + str(n_members))
+    buoys = list(cube['buoy'].values)
+    time = pd.DatetimeIndex(cube['time'].values)
+    n_buoys, n_times = len(buoys), len(time)
+    time_delta = float(np.median(np.diff(time.asi8))) / 1e9 if n_times > 1 else 3600.
+    X, Y, XA, YA, U, V = cube_kinematics(cube)
+    sigma = _position_sigma(position_uncertainty, cube)
+    mean_sigma = float(np.nanmean(sigma))
+
+    # Local linear map from polar stereographic to equal area coordinates
+    J = np.zeros((2, 2) + X.shape)
+    for k, (ddx, ddy) in enumerate([(1., 0.), (0., 1.)]):
+        lon, lat = unproject((X + ddx).ravel(), (Y + ddy).ravel(), 'epsg:3413')
+        xa, ya = project(lon, lat, 'epsg:6931')
+        J[0, k] = xa.reshape(X.shape) - XA
+        J[1, k] = ya.reshape(X.shape) - YA
+
+    position = {b: i for i, b in enumerate(buoys)}
+    names = ENSEMBLE_VARIABLES
+    uncertainty = {'area': 'uncertainty_area', 'divergence': 'uncertainty_divergence',
+                   'vorticity': 'uncertainty_vorticity',
+                   'maximum_shear_strain_rate': 'uncertainty_shear',
+                   'total_deformation': 'uncertainty_total'}
+    out = {}
+    for name in names:
+        for var in [name, 'mean_' + name, 'std_' + name] + \
+                   ([uncertainty[name]] if name in uncertainty else []):
+            out[var] = np.full((len(polygons), n_times), np.nan)
+        out['quantile_' + name] = np.full((len(quantiles), len(polygons), n_times), np.nan)
+
+    def perturbed(members, used, t0, t1):
+        """Perturbed positions and velocities of the buoys <used> at the time steps t0
+        to t1 (exclusive), (member, buoy, time). The velocities are computed with one
+        more time step on each side, so they are the same as on the whole track."""
+        s0, s1 = max(t0 - 1, 0), min(t1 + 1, n_times)
+        noise = np.stack([np.random.default_rng([seed, m]).standard_normal((n_buoys, 2, n_times))
+                          [used, :, s0:s1] for m in members])
+        noise *= sigma[None, used, None, s0:s1]
+        x, y, xa, ya = X[used, s0:s1], Y[used, s0:s1], XA[used, s0:s1], YA[used, s0:s1]
+        j = J[:, :, used, s0:s1]
+        PX = x + noise[:, :, 0]
+        PY = y + noise[:, :, 1]
+        PXA = xa + j[0, 0]*noise[:, :, 0] + j[0, 1]*noise[:, :, 1]
+        PYA = ya + j[1, 0]*noise[:, :, 0] + j[1, 1]*noise[:, :, 1]
+        PU, PV = grid_velocity(time.asi8[s0:s1], PX, PY)
+        keep = slice(t0 - s0, t1 - s0)
+        return [P[..., keep] for P in (PX, PY, PXA, PYA, PU, PV)]
+
+    # A quarter of the memory holds the ensemble results of a chunk of polygons and
+    # time steps (and as much again for sorting them for the quantiles), the rest the
+    # perturbed arrays and intermediate results of strain_rate_arrays for a block of
+    # members. Time steps are only split up if a single polygon does not fit.
+    budget = max_memory_mb * 2**20
+    cells = max(1, int(budget / 4 // (8 * n_members * len(names))))
+    sizes = np.array([len(p) for p in polygons])
+    for n in np.unique(sizes):
+        rows = np.flatnonzero(sizes == n)
+        chunk_size = int(np.clip(cells // max(n_times, 1), 1, len(rows)))
+        window = min(n_times, cells)
+        block_size = max(1, int(budget / 2 // (8 * (window + 2) * 48 * n * chunk_size)))
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            idx = np.array([[position[b] for b in polygons[k]] for k in chunk])
+            used = np.unique(idx)
+            loc = np.searchsorted(used, idx)
+
+            base = strain_rate_arrays(X[idx], Y[idx], XA[idx], YA[idx], U[idx], V[idx],
+                                      mean_sigma, time_delta)
+            for name in names:
+                out[name][chunk] = base[name]
+                if name in uncertainty:
+                    out[uncertainty[name]][chunk] = base[uncertainty[name]]
+            reversed_order = base['reversed'][None, :, None]
+            del base
+
+            for t0 in range(0, n_times, window):
+                t1 = min(t0 + window, n_times)
+                values = {name: np.empty((n_members, len(chunk), t1 - t0)) for name in names}
+                for m0 in range(0, n_members, block_size):
+                    members = range(m0, min(m0 + block_size, n_members))
+                    PX, PY, PXA, PYA, PU, PV = perturbed(members, used, t0, t1)
+                    strain = strain_rate_arrays(PX[:, loc], PY[:, loc], PXA[:, loc], PYA[:, loc],
+                                                PU[:, loc], PV[:, loc], time_delta=time_delta,
+                                                uncertainty=False)
+                    # Orient the areas of all members and time windows like the
+                    # unperturbed polygon
+                    strain['area'] = np.where(strain['reversed'][..., None] != reversed_order,
+                                              -strain['area'], strain['area'])
+                    for name in names:
+                        values[name][m0:m0 + len(members)] = strain[name]
+                    del PX, PY, PXA, PYA, PU, PV, strain
+
+                for name in names:
+                    out['mean_' + name][chunk, t0:t1] = np.mean(values[name], axis=0)
+                    out['std_' + name][chunk, t0:t1] = np.std(values[name], axis=0, ddof=1)
+                    out['quantile_' + name][:, chunk, t0:t1] = np.quantile(values[name], quantiles,
+                                                                           axis=0)
+                    del values[name]
+
+    data = {var: (('polygon', 'time'), out[var]) for var in out if not var.startswith('quantile_')}
+    data.update({var: (('quantile', 'polygon', 'time'), out[var]) for var in out
+                 if var.startswith('quantile_')})
+    vertices = ['-'.join(str(b) for b in p) for p in polygons]
+    return xr.Dataset(data, coords={'polygon': np.arange(len(polygons)), 'time': time,
+                                    'quantile': list(quantiles), 'vertices': ('polygon', vertices)})
@@ -0,0 +1,135 @@
+"""Deformation of the buoy array from Delaunay triangles.
+
+deformation_product computes strain rates for the whole array in a track cube (see
+interpolation.build_track_cube) without choosing polygons by hand. The buoys with
+positions and velocities at a time step are triangulated, and since the set of
+active buoys only changes when a buoy starts, stops or has a gap, the
+triangulation is kept until the set changes. Triangles are put in counter-clockwise
+order and screened at each time step with shape.shape_mask, leaving out triangles
+that have folded over to clockwise order since they were made, and the strain rates
+and uncertainties (analysis.strain_rate_arrays) are only computed for the triangles
+and time steps that pass.
+
+The product is a pair of tables: the triangles with their vertices, and one row
+per triangle and time step with the strain rate components. save_deformation_product
+writes both to a compressed .npz file.
+"""
+import numpy as np
+import pandas as pd
+from scipy.spatial import Delaunay, QhullError
+from icedrift.analysis import cube_kinematics, strain_rate_arrays, STRAIN_VARIABLES
+from icedrift.shape import signed_area, polygon_metrics, shape_mask
+
+
+def _triangulate(x, y):
+    """Delaunay triangles of the points (x, y) as a (triangle, 3) array of point
+    indices in counter-clockwise order. Empty if the points are collinear or fewer
+    than three."""
+    if len(x) < 3:
+        return np.zeros((0, 3), dtype=int)
+    try:
+        tri = Delaunay(np.column_stack([x, y])).simplices
+    except QhullError:
+        return np.zeros((0, 3), dtype=int)
+    clockwise = signed_area(x[tri][:, :, None], y[tri][:, :, None])[:, 0] < 0
+    tri[clockwise] = tri[clockwise][:, [0, 2, 1]]
+    return tri
+
+
+def deformation_product(cube, min_angle_deg=20, min_area=0, max_area=None,
+                        max_aspect_ratio=None, max_perimeter_ratio=None,
+                        position_uncertainty=10, time_delta=None, chunk_size=500):
+    """Strain rates of the Delaunay triangles of the buoys in the track cube <cube>.
+    Triangles are used at time steps where they pass shape.shape_mask with the
+    given limits, i.e. their smallest angle is at least <min_angle_deg>, their area
+    (m^2) is above <min_area>, and their vertices are still counter-clockwise. time_delta
+    defaults to the time step of the cube; chunk_size is the number of time steps
+    screened at once.
+
+    Returns (triangles, deformation): triangles is indexed by triangle id with the
+    buoys vertex_1, vertex_2 and vertex_3 in counter-clockwise order, and
+    deformation has a row for each used triangle and time step with the columns
+    time, triangle, min_angle and those in analysis.STRAIN_VARIABLES, stored as
+    float32.
+    """
+    buoys = np.asarray(cube['buoy'].values)
+    time = pd.DatetimeIndex(cube['time'].values)
+    if time_delta is None:
+        time_delta = (time[1] - time[0]).total_seconds() if len(time) > 1 else 3600.
+    else:
+        time_delta = pd.to_timedelta(time_delta).total_seconds()
+    X, Y, XA, YA, U, V = cube_kinematics(cube)
+    active = np.isfinite(X) & np.isfinite(Y) & np.isfinite(U) & np.isfinite(V)
+
+    # Time steps where the set of active buoys changes
+    change = np.flatnonzero(np.any(active[:, 1:] != active[:, :-1], axis=0)) + 1
+    starts = np.concatenate([[0], change]).astype(int)
+    ends = np.append(change, len(time)).astype(int)
+
+    triangle_ids = {}
+    triangle_vertices = []
+    columns = {var: [] for var in ['time', 'triangle', 'min_angle'] + STRAIN_VARIABLES}
+    for r0, r1 in zip(starts, ends):
+        idx = np.flatnonzero(active[:, r0])
+        tri = _triangulate(X[idx, r0], Y[idx, r0])
+        if len(tri) == 0:
+            continue
+        tri = idx[tri]
+        ids = []
+        for vertices in tri:
+            key = tuple(sorted(vertices))
+            if key not in triangle_ids:
+                triangle_ids[key] = len(triangle_vertices)
+                triangle_vertices.append(vertices)
+            ids.append(triangle_ids[key])
+        ids = np.array(ids)
+
+        for c0 in range(r0, r1, chunk_size):
+            steps = np.arange(c0, min(c0 + chunk_size, r1))
+            metrics = polygon_metrics(X[tri][:, :, steps], Y[tri][:, :, steps])
+            valid = shape_mask(metrics, min_angle_deg, min_area, max_area,
+                               max_aspect_ratio, max_perimeter_ratio)
+            k, j = np.nonzero(valid & (metrics['signed_area'] > 0))
+            # Only the triangles and time steps that pass, each as a series of length 1
+            vertices, j_vertices = tri[k], steps[j][:, None]
+            arrays = [a[vertices, j_vertices][:, :, None] for a in [X, Y, XA, YA, U, V]]
+            strain = strain_rate_arrays(*arrays, position_uncertainty, time_delta)
+            columns['time'].append(time.asi8[steps[j]])
+            columns['triangle'].append(ids[k].astype(np.int32))
+            columns['min_angle'].append(metrics['min_angle'][k, j].astype(np.float32))
+            for var in STRAIN_VARIABLES:
+                columns[var].append(strain[var][:, 0].astype(np.float32))
+
+    triangle_vertices = np.array(triangle_vertices).reshape(-1, 3)
+    triangles = pd.DataFrame({'vertex_{}'.format(i + 1): buoys[triangle_vertices[:, i]]
+                              for i in range(3)})
+    triangles.index.name = 'triangle'
+
+    if len(columns['time']) == 0:
+        columns = {var: [np.zeros(0, dtype=np.float32)] for var in columns}
+        columns['time'] = [np.zeros(0, dtype=np.int64)]
+        columns['triangle'] = [np.zeros(0, dtype=np.int32)]
+    deformation = pd.DataFrame({var: np.concatenate(columns[var]) for var in columns})
+    deformation['time'] = pd.to_datetime(deformation['time'])
+    deformation = deformation.sort_values(['time', 'triangle'], kind='stable').reset_index(drop=True)
+    return triangles, deformation
+
+
+def save_deformation_product(path, triangles, deformation):
+    """Writes the output of deformation_product to the compressed .npz file <path>."""
+    arrays = {'triangle_' + col: triangles[col].values.astype(str) for col in triangles.columns}
+    arrays.update({col: deformation[col].values for col in deformation.columns if col != 'time'})
+    arrays['time'] = deformation['time'].values.astype('datetime64[ns]').astype(np.int64)
+    np.savez_compressed(path, **arrays)
+
+
+def load_deformation_product(path):
+    """Reads a file written by save_deformation_product. Returns (triangles, deformation)."""
+    with np.load(path) as f:
+        triangles = pd.DataFrame({key[len('triangle_'):]: f[key] for key in f.files
+                                  if key.startswith('triangle_')})
+        triangles.index.name = 'triangle'
+        deformation = pd.DataFrame({key: f[key] for key in f.files
+                                    if not key.startswith('triangle_') and key != 'time'})
+        deformation.insert(0, 'time', pd.to_datetime(f['time']))
+    return triangles, deformation[['time', 'triangle', 'min_angle'] + STRAIN_VARIABLES]
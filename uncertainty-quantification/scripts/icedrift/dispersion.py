@@ -0,0 +1,192 @@
+"""Absolute and relative dispersion of buoys with aligned velocities.
+
+The functions here take velocity arrays of shape (buoy, time) on a common time
+step, such as the u and v variables of a track cube from
+interpolation.build_track_cube, and treat the first time step as time 0. The
+displacement of each buoy at lag k is the sum of its velocities at steps 1 to k
+times the time step, so a buoy drops out of the statistics from its first missing
+velocity onward.
+
+absolute_dispersion is the variance of the displacements about the ensemble mean
+at each lag, so that the mean drift of the ice does not count as dispersion.
+relative_dispersion is the mean square change of the separation of buoy pairs,
+binned by their initial separation.
+
+Both go through the buoys (or pairs of blocks of buoys) in blocks, computing the
+displacements and bootstrap weights of a block when it is used, and only keep
+running sums per time step, so memory does not grow with the number of buoys or
+pairs. Confidence intervals come from a bootstrap over buoys with Poisson
+weights: each replicate gives every buoy a random weight with mean 1 (pairs get
+the product of the weights of their buoys), and the weighted sums of all
+replicates are accumulated together with one matrix product per block. The
+weights of each buoy come from a generator seeded with (seed, buoy), so they do
+not depend on the block size.
+"""
+import warnings
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+def _displacements(u, v, dt):
+    """Displacements (m) since time 0 of buoys with velocities u and v (m/s) of shape
+    (buoy, time) and time step dt (seconds)."""
+    dx = np.zeros(u.shape)
+    dy = np.zeros(v.shape)
+    dx[:, 1:] = np.cumsum(u[:, 1:] * dt, axis=1)
+    dy[:, 1:] = np.cumsum(v[:, 1:] * dt, axis=1)
+    return dx, dy
+
+
+def _bootstrap_weights(start, stop, n_boot, seed):
+    """Weights of the buoys start to stop (exclusive) as an array of shape
+    (stop - start, 1 + n_boot): ones for the estimate itself, followed by Poisson(1)
+    weights for each bootstrap replicate."""
+    weights = np.ones((stop - start, 1 + n_boot))
+    for k, b in enumerate(range(start, stop)):
+        weights[k, 1:] = np.random.default_rng([seed, b]).poisson(1, n_boot)
+    return weights
+
+
+def _interval(replicates, confidence):
+    """Lower and upper percentile bounds over the first axis of <replicates>."""
+    alpha = (1 - confidence) / 2
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return np.nanquantile(replicates, [alpha, 1 - alpha], axis=0)
+
+
+def _truncate(u, v, dt, max_lag):
+    u, v = np.asarray(u, dtype=float), np.asarray(v, dtype=float)
+    if max_lag is not None:
+        n = int(pd.to_timedelta(max_lag).total_seconds() // dt) + 1
+        u, v = u[:, :n], v[:, :n]
+    return u, v
+
+
+def absolute_dispersion(u, v, dt=3600, max_lag=None, n_boot=1000, confidence=0.95,
+                        seed=0, max_memory_mb=256):
+    """Absolute dispersion of buoys with velocities u and v (m/s) of shape
+    (buoy, time) on a common time step of dt seconds, up to max_lag (e.g. '30D').
+    At each lag, the variance of the x and y displacements about their ensemble
+    mean is sum((X - mean(X))**2) / (n - 1) over the n buoys with data.
+
+    Returns a dataframe indexed by lag with the number of buoys n and the
+    dispersion in m^2 in the columns x, y and total (= x + y), plus the columns
+    <name>_lower and <name>_upper with the bootstrap confidence interval if
+    n_boot > 0.
+
+    Example
+    absolute_dispersion(cube['u'].values, cube['v'].values, dt=3600, max_lag='30D')
+    """
+    u, v = _truncate(u, v, dt, max_lag)
+    n_buoys, n_times = u.shape
+    block_size = max(1, int(max_memory_mb * 2**20 // (8 * (8 * n_times + 1 + n_boot))))
+
+    # Weighted counts and power sums for each replicate and time step. The
+    # displacements are shifted by the mean of the first block to keep the sums of
+    # squares from losing precision when the mean drift is large.
+    S0 = np.zeros((1 + n_boot, n_times))
+    S1 = {c: np.zeros((1 + n_boot, n_times)) for c in 'xy'}
+    S2 = {c: np.zeros((1 + n_boot, n_times)) for c in 'xy'}
+    shift = None
+    for b0 in range(0, n_buoys, block_size):
+        b1 = min(b0 + block_size, n_buoys)
+        D = dict(zip('xy', _displacements(u[b0:b1], v[b0:b1], dt)))
+        valid = np.isfinite(D['x']) & np.isfinite(D['y'])
+        if shift is None:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', category=RuntimeWarning)
+                shift = {c: np.nan_to_num(np.nanmean(np.where(valid, D[c], np.nan), axis=0))
+                         for c in 'xy'}
+        W = _bootstrap_weights(b0, b1, n_boot, seed).T
+        S0 += W @ valid
+        for c in 'xy':
+            d = np.where(valid, D[c] - shift[c], 0)
+            S1[c] += W @ d
+            S2[c] += W @ d**2
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var = {c: np.where(S0 > 1, (S2[c] - S1[c]**2 / S0) / (S0 - 1), np.nan) for c in 'xy'}
+    var['total'] = var['x'] + var['y']
+
+    result = pd.DataFrame({'n': S0[0].astype(int)},
+                          index=pd.Index(pd.to_timedelta(np.arange(n_times) * dt, unit='s'),
+                                         name='lag'))
+    for name in ['x', 'y', 'total']:
+        result[name] = var[name][0]
+    if n_boot > 0:
+        for name in ['x', 'y', 'total']:
+            result[name + '_lower'], result[name + '_upper'] = _interval(var[name][1:], confidence)
+    return result
+
+
+def relative_dispersion(u, v, x0, y0, dt=3600, bins=(0, 10e3, 25e3, 50e3, 100e3, 200e3),
+                        max_lag=None, n_boot=1000, confidence=0.95, seed=0,
+                        max_memory_mb=256):
+    """Relative dispersion of all pairs of buoys with velocities u and v (m/s) of
+    shape (buoy, time) on a common time step of dt seconds, up to max_lag. x0 and
+    y0 are the positions (m) of the buoys at time 0, and pairs are grouped by their
+    initial separation into the intervals [bins[k], bins[k+1]); pairs outside the
+    bins or without a position at time 0 are left out. The relative dispersion is
+    the mean of |D(t) - D(0)|**2 over the pairs in a bin, where D is the separation
+    vector.
+
+    Returns an xarray Dataset with dimensions (separation, lag), where separation
+    is the center of each bin (with separation_min and separation_max as
+    coordinates), holding n_pairs and dispersion (m^2), plus dispersion_lower and
+    dispersion_upper with the bootstrap confidence interval if n_boot > 0. The
+    bootstrap resamples buoys, not pairs, since pairs sharing a buoy are not
+    independent.
+    """
+    u, v = _truncate(u, v, dt, max_lag)
+    n_buoys, n_times = u.shape
+    bins = np.asarray(bins, dtype=float)
+    n_bins = len(bins) - 1
+    x0, y0 = np.asarray(x0, dtype=float), np.asarray(y0, dtype=float)
+    # Blocks of buoys whose pairs fit in about max_memory_mb
+    block_size = max(1, int(np.sqrt(max_memory_mb * 2**20 / (8 * (6 * n_times + 2 * (1 + n_boot))))))
+
+    def block(b0):
+        b1 = min(b0 + block_size, n_buoys)
+        dx, dy = _displacements(u[b0:b1], v[b0:b1], dt)
+        return np.arange(b0, b1), dx, dy, _bootstrap_weights(b0, b1, n_boot, seed)
+
+    S0 = np.zeros((1 + n_boot, n_bins, n_times))
+    S1 = np.zeros((1 + n_boot, n_bins, n_times))
+    for a0 in range(0, n_buoys, block_size):
+        buoys_a, dx_a, dy_a, W_a = block(a0)
+        for b0 in range(a0, n_buoys, block_size):
+            buoys_b, dx_b, dy_b, W_b = block(b0) if b0 > a0 else (buoys_a, dx_a, dy_a, W_a)
+            # Pairs i < j with i in block a and j in block b, as local indices
+            i, j = [ij.ravel() for ij in np.meshgrid(np.arange(len(buoys_a)), np.arange(len(buoys_b)),
+                                                     indexing='ij')]
+            if b0 == a0:
+                i, j = i[i < j], j[i < j]
+            with np.errstate(invalid='ignore'):
+                k = np.digitize(np.hypot(x0[buoys_a[i]] - x0[buoys_b[j]],
+                                         y0[buoys_a[i]] - y0[buoys_b[j]]), bins) - 1
+            keep = (k >= 0) & (k < n_bins)
+            i, j, k = i[keep], j[keep], k[keep]
+            change = (dx_a[i] - dx_b[j])**2 + (dy_a[i] - dy_b[j])**2
+            valid = np.isfinite(change)
+            change = np.where(valid, change, 0)
+            W = W_a[i] * W_b[j]
+            for b in np.unique(k):
+                sel = k == b
+                S0[:, b] += W[sel].T @ valid[sel]
+                S1[:, b] += W[sel].T @ change[sel]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dispersion = np.where(S0 > 0, S1 / S0, np.nan)
+
+    data = {'n_pairs': (('separation', 'lag'), S0[0].astype(int)),
+            'dispersion': (('separation', 'lag'), dispersion[0])}
+    if n_boot > 0:
+        lower, upper = _interval(dispersion[1:], confidence)
+        data['dispersion_lower'] = (('separation', 'lag'), lower)
+        data['dispersion_upper'] = (('separation', 'lag'), upper)
+    return xr.Dataset(data, coords={'separation': (bins[:-1] + bins[1:]) / 2,
+                                    'separation_min': ('separation', bins[:-1]),
+                                    'separation_max': ('separation', bins[1:]),
+                                    'lag': pd.to_timedelta(np.arange(n_times) * dt, unit='s')})
@@ -0,0 +1,163 @@
+"""Filling gaps in buoy tracks from nearby buoys.
+
+Works on a track cube from interpolation.build_track_cube, where each buoy's
+missing grid points between its first and last position are gaps. The
+displacement of a buoy during a gap is estimated from the displacement of its
+nearest neighbours that have data, weighted by their distance and by how well
+their velocity was correlated with the buoy's velocity just before the gap.
+Estimates are made forward from the last position before the gap and backward
+from the first position after it, and blended so that the filled track joins the
+observations at both ends.
+
+Neighbours are found with a KD-tree of the buoy positions at each grid time. The
+trees are built when a gap first needs them and reused for other gaps starting or
+ending at the same time, so filling a whole deployment builds at most one tree per
+time step.
+"""
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from icedrift.projection import unproject
+from icedrift.analysis import grid_velocity
+
+
+def find_gaps(valid):
+    """Start and end (exclusive) of each run of missing values in the boolean array
+    <valid> that has valid values on both sides."""
+    change = np.diff(valid.astype(int))
+    starts = np.flatnonzero(change == -1) + 1
+    ends = np.flatnonzero(change == 1) + 1
+    if len(ends) > 0 and len(starts) > 0:
+        ends = ends[ends > starts[0]]
+        starts = starts[:len(ends)]
+    else:
+        starts, ends = starts[:0], ends[:0]
+    return starts, ends
+
+
+def _velocity_correlation(U, V, b, neighbours, window):
+    """Vector correlation between the velocity of buoy b and each neighbour over the
+    time steps in <window>. NaN where fewer than two steps have data for both."""
+    ub, vb = U[b, window], V[b, window]
+    un, vn = U[neighbours][:, window], V[neighbours][:, window]
+    both = np.isfinite(ub + vb) & np.isfinite(un + vn)
+    ub, vb = np.where(both, ub, 0), np.where(both, vb, 0)
+    un, vn = np.where(both, un, 0), np.where(both, vn, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = np.sum(ub*un + vb*vn, axis=1) / np.sqrt(np.sum(ub**2 + vb**2, axis=1) *
+                                                       np.sum(un**2 + vn**2, axis=1))
+    corr[both.sum(axis=1) < 2] = np.nan
+    return corr
+
+
+def _side_estimate(XY, U, V, b, anchor, steps, window, tree, k, max_distance, min_distance):
+    """Positions of buoy b at <steps> estimated from the displacements of its
+    neighbours since time step <anchor>, where b has a position. Returns the
+    estimate (2, len(steps)), the weighted variance of the neighbour displacements
+    and the number of neighbours used at each step."""
+    kdtree, active = tree
+    n = len(steps)
+    estimate, variance = np.full((2, n), np.nan), np.full(n, np.nan)
+    distance, i = kdtree.query(XY[:, b, anchor], k=min(k + 1, len(active)),
+                               distance_upper_bound=max_distance)
+    distance, i = np.atleast_1d(distance), np.atleast_1d(i)
+    found = np.isfinite(distance)
+    neighbours = active[i[found]]
+    distance = distance[found][neighbours != b][:k]
+    neighbours = neighbours[neighbours != b][:k]
+    if len(neighbours) == 0:
+        return estimate, variance, np.zeros(n, dtype=int)
+
+    corr = _velocity_correlation(U, V, b, neighbours, window)
+    weight = np.where(np.isnan(corr), 0, np.maximum(corr, 0)) / np.maximum(distance, min_distance)
+    D = XY[:, neighbours][:, :, steps] - XY[:, neighbours, anchor][:, :, None]
+    w = np.where(np.isfinite(D.sum(axis=0)), weight[:, None], 0)
+    total = w.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nansum(w * D, axis=1) / total
+        variance = np.nansum(w * np.sum((D - mean[:, None])**2, axis=0), axis=0) / total
+    estimate = XY[:, b, anchor][:, None] + mean
+    return estimate, variance, (w > 0).sum(axis=0)
+
+
+def fill_gaps(cube, k=4, max_distance=100e3, min_distance=1e3, corr_window='2D',
+              max_gap=None):
+    """Fills the gaps of each buoy in the track cube <cube> (see
+    interpolation.build_track_cube) from its k nearest neighbours within
+    max_distance meters. Each neighbour's displacement since the last position
+    before the gap (and until the first position after it) is weighted by the
+    correlation of its velocity with the buoy's velocity over corr_window before
+    (after) the gap, divided by its distance (at least min_distance). Neighbours
+    with negative or unknown correlation are not used. Gaps longer than max_gap
+    (e.g. '3D') are left as they are.
+
+    Returns a copy of the cube with the filled positions and velocities and the
+    variables
+    filled: True at filled grid points
+    sigma_fill: uncertainty of the filled position in meters, from the weighted
+                spread of the neighbour displacements and the misfit of the forward
+                estimate at the end of the gap
+    n_neighbours: number of neighbours used at each filled point
+    """
+    XY = np.stack([cube['x'].values, cube['y'].values]).astype(float)
+    U, V = cube['u'].values, cube['v'].values
+    n_buoys, n_times = XY.shape[1:]
+    time = pd.DatetimeIndex(cube['time'].values)
+    step = (time[1] - time[0]) if n_times > 1 else pd.to_timedelta(1, unit='h')
+    n_window = max(int(pd.to_timedelta(corr_window) / step), 2)
+    max_steps = np.inf if max_gap is None else pd.to_timedelta(max_gap) / step
+    valid = np.isfinite(XY).all(axis=0)
+
+    trees = {}
+    def tree_at(j):
+        if j not in trees:
+            active = np.flatnonzero(valid[:, j])
+            trees[j] = (cKDTree(XY[:, active, j].T), active)
+        return trees[j]
+
+    filled_XY = XY.copy()
+    filled = np.zeros((n_buoys, n_times), dtype=bool)
+    sigma = np.full((n_buoys, n_times), np.nan)
+    n_used = np.zeros((n_buoys, n_times), dtype=int)
+    for b in range(n_buoys):
+        for g0, g1 in zip(*find_gaps(valid[b])):
+            if g1 - g0 > max_steps:
+                continue
+            steps = np.arange(g0, g1 + 1)
+            before = slice(max(g0 - n_window, 0), g0)
+            after = slice(g1, min(g1 + n_window, n_times))
+            forward, var_f, n_f = _side_estimate(XY, U, V, b, g0 - 1, steps, before, tree_at(g0 - 1),
+                                                 k, max_distance, min_distance)
+            backward, var_b, n_b = _side_estimate(XY, U, V, b, g1, steps, after, tree_at(g1),
+                                                  k, max_distance, min_distance)
+
+            # Linear blend of the two estimates, falling back on either one alone
+            alpha = (steps - (g0 - 1)) / (g1 - g0 + 1)
+            w_f = np.where(np.isnan(forward[0]), 0, 1 - alpha)
+            w_b = np.where(np.isnan(backward[0]), 0, alpha)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                estimate = (w_f * np.nan_to_num(forward) + w_b * np.nan_to_num(backward)) / (w_f + w_b)
+                a = w_b / (w_f + w_b)
+                var = (1 - a)**2 * np.nan_to_num(var_f) + a**2 * np.nan_to_num(var_b)
+            closure = np.hypot(*(forward[:, -1] - XY[:, b, g1]))
+            if np.isfinite(closure):
+                var = var + (2 * alpha * (1 - alpha) * closure)**2 * (w_f > 0) * (w_b > 0)
+
+            ok = np.isfinite(estimate).all(axis=0)[:-1]
+            idx = steps[:-1][ok]
+            filled_XY[:, b, idx] = estimate[:, :-1][:, ok]
+            filled[b, idx] = True
+            sigma[b, idx] = np.sqrt(var[:-1][ok])
+            n_used[b, idx] = np.maximum(n_f, n_b)[:-1][ok]
+
+    out = cube.copy(deep=True)
+    out['x'].values[:] = filled_XY[0]
+    out['y'].values[:] = filled_XY[1]
+    lon, lat = unproject(filled_XY[0][filled], filled_XY[1][filled])
+    out['longitude'].values[filled] = lon
+    out['latitude'].values[filled] = lat
+    out['u'].values[:], out['v'].values[:] = grid_velocity(time.asi8, filled_XY[0], filled_XY[1])
+    out['filled'] = (('buoy', 'time'), filled)
+    out['sigma_fill'] = (('buoy', 'time'), sigma)
+    out['n_neighbours'] = (('buoy', 'time'), n_used)
+    return out
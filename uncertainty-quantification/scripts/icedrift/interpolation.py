@@ -2,82 +2,161 @@
 
 TBD: rewrite varnames for consistency. should specify xvar to either be lon/lat or x/y, and if it's x/y don't do the transformation.
 """
+import os
+import time
+import tracemalloc
 import pandas as pd
-import pyproj
 import numpy as np 
-from scipy.interpolate import interp1d
+from scipy.interpolate import (interp1d, make_interp_spline, make_smoothing_spline,
+                               CubicSpline, PchipInterpolator, Akima1DInterpolator)
 import xarray as xr
+from icedrift.projection import project, projected_xy, unproject
+from icedrift.cleaning import label_segments, segment_table
+from icedrift.analysis import grid_velocity
 
-def regrid_buoy_track(buoy_df, precision='5min'):
+def regrid_buoy_track(buoy_df, precision='5min', method='cubic'):
     """Applies interp1d with cubic splines to align the buoy track to a 5 min grid.
     Assumes that the dataframe buoy_df has a datetime index. Errors are reported by
     computing the difference between the interpolating curve and the original
     data points, then linearly interpolating the error to the new grid. 
     Calculations carried out in north polar stereographic coordinates.
+
+    The error is the round trip of the regridding: a spline through the regridded
+    positions is evaluated at the original times and compared with the data. The
+    two splines are built directly with make_interp_spline (the same not-a-knot
+    cubic that interp1d uses) for x and y together, and the error is assigned to
+    each new time from the nearest original time by a binary search. buoy_df is
+    not modified. Other interpolators can be chosen by name with <method>, see
+    INTERPOLATORS.
     """
 
-    projIn = 'epsg:4326' # WGS 84 Ellipsoid
-    projOut = 'epsg:3413' # NSIDC Polar Stereographic
-    transform_to_xy = pyproj.Transformer.from_crs(projIn, projOut, always_xy=True)
-    transform_to_ll = pyproj.Transformer.from_crs(projOut, projIn, always_xy=True)
-    
-    lon = buoy_df.longitude.values
-    lat = buoy_df.latitude.values
+    proj = 'epsg:3413' # NSIDC Polar Stereographic
     
     xvar = 'x_stere'
     yvar = 'y_stere'
     
-    x, y = transform_to_xy.transform(lon, lat)
-    buoy_df[xvar] = x
-    buoy_df[yvar] = y
+    X = np.vstack(projected_xy(buoy_df, proj)).T
 
+    t_ns = buoy_df.index.asi8
+    t_seconds = (t_ns - t_ns.min()) / 1e9
 
-    t = pd.Series(buoy_df.index)
-    t0 = t.min()
-    t_seconds = pd.to_timedelta(t - t0).dt.total_seconds()
+    # The new times are the original ones: the rounding to <precision> was applied
+    # to a Series of datetimes, which Series.round leaves as they are
+    tnew = pd.DatetimeIndex(buoy_df.index)
+    tnew = tnew[~tnew.duplicated()]
+    tnew_seconds = (tnew.asi8 - t_ns.min()) / 1e9
 
-    tnew = t.round(precision)
-     # Drop data points that are closer than <precision> to each other
-    tnew = tnew.loc[~tnew.duplicated()]
-    
-    tnew_seconds = pd.to_timedelta(tnew - t0).dt.total_seconds()
-
-    X = buoy_df[[xvar, yvar]].T.values
-    Xnew = interp1d(t_seconds, X, bounds_error=False, kind='cubic')(tnew_seconds)
-    idx = ~np.isnan(Xnew.sum(axis=0))
-    buoy_df_new = pd.DataFrame(data=np.round(Xnew.T, 5), 
+    Xnew = _evaluate_spline(t_seconds, X, tnew_seconds, method)
+    idx = ~np.isnan(Xnew.sum(axis=1))
+    buoy_df_new = pd.DataFrame(data=np.round(Xnew, 5), 
                           columns=[xvar, yvar],
                           index=tnew)
     buoy_df_new.index.names = ['datetime']
 
     # Next, get the absolute position error
-    Xnew_at_old = interp1d(
-        tnew_seconds[idx], Xnew[:, idx],
-        bounds_error=False, kind='cubic')(t_seconds)
-    X_err = pd.Series(
-        np.sqrt(np.sum((X - Xnew_at_old)**2, axis=0)), t).ffill().bfill()
-
-    # Finally, assign absolute position error to the new dataframe
-    buoy_df_new['sigma_x_regrid'] = interp1d(t_seconds, X_err,
-                                             bounds_error=False,
-                                             kind='nearest')(tnew_seconds)
+    Xnew_at_old = _evaluate_spline(tnew_seconds[idx], Xnew[idx], t_seconds, method)
+    X_err = pd.Series(np.sqrt(np.sum((X - Xnew_at_old)**2, axis=1))).ffill().bfill().values
 
-    x = buoy_df_new[xvar].values
-    y = buoy_df_new[yvar].values
+    # Finally, assign absolute position error to the new dataframe, taking the
+    # value at the nearest original time as interp1d(kind='nearest') does
+    nearest = np.searchsorted(t_seconds[:-1] + np.diff(t_seconds) / 2, tnew_seconds, side='left')
+    inside = (tnew_seconds >= t_seconds[0]) & (tnew_seconds <= t_seconds[-1])
+    buoy_df_new['sigma_x_regrid'] = np.where(inside, X_err[nearest], np.nan)
 
-    lon, lat = transform_to_ll.transform(x, y)
+    lon, lat = unproject(buoy_df_new[xvar].values, buoy_df_new[yvar].values, proj)
     buoy_df_new['longitude'] = lon
     buoy_df_new['latitude'] = lat
 
     return buoy_df_new
 
 
+def _evaluate_spline(t, X, tnew, method='cubic'):
+    """Interpolator <method> (see INTERPOLATORS) through the rows of X at times t,
+    evaluated at tnew, with NaN outside the range of t. The default not-a-knot cubic
+    spline matches interp1d(kind='cubic', bounds_error=False)."""
+    return get_interpolator(method)(t, X.T)(tnew).T
+
+
+def _bounded(f, t):
+    """Wraps the piecewise polynomial or spline f, evaluated along the last axis,
+    so that it returns NaN outside the range of t, as interp1d(bounds_error=False)."""
+    def evaluate(tnew):
+        tnew = np.asarray(tnew, dtype=float)
+        Xnew = np.array(f(tnew), dtype=float)
+        Xnew[..., (tnew < t[0]) | (tnew > t[-1])] = np.nan
+        return Xnew
+    return evaluate
+
+
+def _smoothing_spline(t, X):
+    """Cubic smoothing spline of each row of X, with the smoothing chosen by
+    generalized cross-validation."""
+    X = np.atleast_2d(X)
+    splines = [make_smoothing_spline(t, row) for row in X.reshape(-1, X.shape[-1])]
+    shape = X.shape[:-1]
+    return lambda tnew: np.array([spline(tnew) for spline in splines]).reshape(shape + (len(tnew),))
+
+
+# Interpolators by name. Each entry maps (t, X), with times t in seconds and the
+# data along the last axis of X, to a function of the new times, and gives the
+# fewest points the method accepts. interpolate_buoy_track, regrid_buoy_track,
+# interpolate_buoy_track_to_reference and process_simba.interpolate_rotation
+# take one of these names as their method argument.
+INTERPOLATORS = {
+    'linear': (lambda t, X: interp1d(t, X, bounds_error=False, kind='linear'), 2),
+    'cubic': (lambda t, X: _bounded(make_interp_spline(t, X, k=3, axis=-1), t), 4),
+    'natural': (lambda t, X: _bounded(CubicSpline(t, X, axis=-1, bc_type='natural'), t), 3),
+    'pchip': (lambda t, X: _bounded(PchipInterpolator(t, X, axis=-1), t), 2),
+    'akima': (lambda t, X: _bounded(Akima1DInterpolator(t, X, axis=-1), t), 3),
+    'smoothing': (lambda t, X: _bounded(_smoothing_spline(t, X), t), 5),
+}
+
+
+def get_interpolator(method='cubic'):
+    """Returns the function that builds the interpolator <method> (a name in
+    INTERPOLATORS) from times in seconds and data along the last axis. The times
+    need not be sorted, and only the first of repeated times is used."""
+    if method not in INTERPOLATORS:
+        raise ValueError('Unknown interpolation method {}, use one of {}'.format(
+            method, ', '.join(INTERPOLATORS)))
+    build = INTERPOLATORS[method][0]
+    return lambda t, X: build(*_sorted_unique(t, X))
+
+
+def _sorted_unique(t, X):
+    """Sorts the times t, and X along its last axis, and drops repeated times. The
+    spline fits need strictly increasing times, which interp1d did not ask for."""
+    t = np.asarray(t, dtype=float)
+    if np.all(np.diff(t) > 0):
+        return t, X
+    order = np.argsort(t, kind='stable')
+    t, X = t[order], np.asarray(X)[..., order]
+    first = np.insert(np.diff(t) > 0, 0, True)
+    return t[first], X[..., first]
+
+
 # Interpolate to a regular grid
 def interpolate_buoy_track(buoy_df, xvar='longitude', yvar='latitude', 
-                           freq='1H', maxgap_minutes=120):
+                           freq='1H', maxgap_minutes=120, by_segment=False,
+                           return_splines=False, method='cubic'):
     """Applies interp1d with cubic splines to the pair of variables specied by
     xvar and yvar. Assumes that the dataframe buoy_df has a datetime index.
     Frequency should be in a form understandable to pandas date_range, e.g. '1H' for hourly.
+
+    Other interpolators than cubic splines can be chosen by name with <method>,
+    see INTERPOLATORS.
+
+    Grid points are kept where the average time step around the previous observation
+    is less than maxgap_minutes. With by_segment=True, the track is split wherever
+    the time step is longer than 2*maxgap_minutes, since no grid point is kept inside
+    such a step, and a separate spline is fit to each segment (of lower order for
+    segments too short for <method>). Only the kept grid points are evaluated, and
+    data on one side of a gap do not affect the fit on the other side.
+
+    If return_splines is True, also returns the segment table of the track (see
+    cleaning.segment_table) with the fitted interpolator of each segment in the
+    'spline' column, which can be evaluated at other times with evaluate_splines.
+    Without by_segment, the table has a single segment covering the track.
     """
 
     buoy_df = buoy_df.dropna(subset=[xvar, yvar]).copy()
@@ -86,20 +165,12 @@ def interpolate_buoy_track(buoy_df, xvar='longitude', yvar='latitude',
     # project to north polar stereographic first.
     if (xvar == 'longitude') | (xvar == 'lon'):
         reproject = True
-        projIn = 'epsg:4326' # WGS 84 Ellipsoid
-        projOut = 'epsg:3413' # NSIDC Polar Stereographic
-        transform_to_xy = pyproj.Transformer.from_crs(
-            projIn, projOut, always_xy=True)
-        transform_to_ll = pyproj.Transformer.from_crs(
-            projOut, projIn, always_xy=True)
-
-        lon = buoy_df.longitude.values
-        lat = buoy_df.latitude.values
+        proj = 'epsg:3413' # NSIDC Polar Stereographic
 
         xvar = 'x_stere'
         yvar = 'y_stere'
 
-        x, y = transform_to_xy.transform(lon, lat)
+        x, y = projected_xy(buoy_df, proj)
         buoy_df[xvar] = x
         buoy_df[yvar] = y
     else:
@@ -118,13 +189,34 @@ def interpolate_buoy_track(buoy_df, xvar='longitude', yvar='latitude',
     time_till_next = time_till_next.dt.total_seconds()
     time_since_last = time_since_last.dt.total_seconds()
 
-    Xnew = interp1d(dt, X.values, bounds_error=False, kind='cubic')(dtnew).T
-
     # add information on initial time resolution 
     data_gap = interp1d(dt, np.sum(np.array([time_till_next.fillna(0),
                                              time_since_last.fillna(0)]), axis=0),
                   kind='previous', bounds_error=False)(dtnew)
 
+    if by_segment:
+        threshold_gap = pd.to_timedelta(2*maxgap_minutes, unit='min')
+        segment = label_segments(buoy_df.index, threshold_gap)
+        keep = np.round(data_gap/60)/2 < maxgap_minutes
+        bounds = np.flatnonzero(np.diff(segment, prepend=-1, append=segment[-1] + 1))
+        t_ns = buoy_df.index.asi8
+        tnew_ns = tnew.asi8
+        Xnew = np.full((len(tnew), 2), np.nan)
+        splines = []
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            spline = _segment_spline(t_ns[a:b], X.values[:, a:b], method)
+            splines.append(spline)
+            i0 = np.searchsorted(tnew_ns, t_ns[a], side='left')
+            i1 = np.searchsorted(tnew_ns, t_ns[b - 1], side='right')
+            i = i0 + np.flatnonzero(keep[i0:i1])
+            if spline is not None and len(i) > 0:
+                Xnew[i] = spline((tnew_ns[i] - t_ns[a]) / 1e9).T
+    else:
+        threshold_gap = t.max() - t.min() + pd.to_timedelta(1, unit='s')
+        spline = get_interpolator(method)(dt.values, X.values)
+        splines = [spline]
+        Xnew = spline(dtnew).T
+
     df_new = pd.DataFrame(data=np.round(Xnew, 5), 
                           columns=[xvar, yvar],
                           index=tnew)
@@ -137,17 +229,56 @@ def interpolate_buoy_track(buoy_df, xvar='longitude', yvar='latitude',
         x = df_new[xvar].values
         y = df_new[yvar].values
 
-        lon, lat = transform_to_ll.transform(x, y)
+        lon, lat = unproject(x, y, proj)
         df_new['longitude'] = np.round(lon, 5)
         df_new['latitude'] = np.round(lat, 5)
 
+    if return_splines:
+        segments = segment_table(buoy_df, threshold_gap)
+        segments['spline'] = splines
+        return df_new, segments
     return df_new
 
 
-def interpolate_buoy_track_to_reference(buoy_df, target_df, xvar='longitude', yvar='latitude'):
+def _segment_spline(t, X, method='cubic'):
+    """Interpolator for one segment of a track with int64 times <t>, in seconds since
+    the start of the segment. Uses <method>, or if the segment has too few points for
+    it, the highest order spline the number of points allows."""
+    if len(t) >= INTERPOLATORS[method][1]:
+        return get_interpolator(method)((t - t[0]) / 1e9, X)
+    kind = {1: None, 2: 'linear', 3: 'quadratic'}.get(len(t), 'cubic')
+    if kind is None:
+        return None
+    return interp1d((t - t[0]) / 1e9, X, bounds_error=False, kind=kind)
+
+
+def evaluate_splines(segments, times):
+    """Evaluates the interpolators returned by interpolate_buoy_track with
+    return_splines=True at <times>. Returns an array of shape (2, len(times)) in
+    the coordinates that were interpolated (x_stere and y_stere if the track was
+    given in longitude and latitude), with NaN outside the segments."""
+    times = pd.DatetimeIndex(times)
+    X = np.full((2, len(times)), np.nan)
+    start = pd.DatetimeIndex(segments['start'])
+    end = pd.DatetimeIndex(segments['end'])
+    k = np.searchsorted(start, times, side='right') - 1
+    inside = (k >= 0) & (times <= end[np.maximum(k, 0)])
+    for j in np.unique(k[inside]):
+        spline = segments['spline'].iloc[j]
+        if spline is None:
+            # Segments with a single observation have no interpolator
+            continue
+        i = np.flatnonzero(inside & (k == j))
+        X[:, i] = spline(pd.to_timedelta(times[i] - start[j]).total_seconds())
+    return X
+
+
+def interpolate_buoy_track_to_reference(buoy_df, target_df, xvar='longitude', yvar='latitude',
+                                        method='cubic'):
     """Applies interp1d with cubic splines to the pair of variables specied by
     xvar and yvar. Assumes that the dataframe buoy_df has a datetime index.
-    Interpolates to target_df index where there is overlap.
+    Interpolates to target_df index where there is overlap. Other interpolators
+    can be chosen by name with <method>, see INTERPOLATORS.
     """
 
     t = pd.Series(buoy_df.index)
@@ -157,7 +288,7 @@ def interpolate_buoy_track_to_reference(buoy_df, target_df, xvar='longitude', yv
     dtnew = pd.to_timedelta(tnew - t.min()).dt.total_seconds()
     
     X = buoy_df[[xvar, yvar]].T
-    Xnew = interp1d(dt, X.values, bounds_error=False, kind='cubic')(dtnew).T
+    Xnew = get_interpolator(method)(dt.values, X.values)(dtnew.values).T
 
     df_new = pd.DataFrame(data=np.round(Xnew, 5), 
                           columns=[xvar, yvar],
@@ -165,31 +296,269 @@ def interpolate_buoy_track_to_reference(buoy_df, target_df, xvar='longitude', yv
     df_new.index.names = ['datetime']
     return df_new
 
+
+def interpolate_tracks_to_references(data, targets=None, xvar='longitude', yvar='latitude',
+                                     method='cubic', union=False, tidy=True):
+    """Batched interpolate_buoy_track_to_reference. Interpolates each track in the
+    dictionary <data> (buoy: dataframe with a datetime index) to the index of every
+    target in the dictionary <targets> (name: dataframe or DatetimeIndex), by default
+    the tracks in data themselves. The interpolator of each buoy is fit once and
+    evaluated at the times of all targets in one call, so co-locating N buoys with
+    each other takes N fits rather than N^2.
+
+    With union=True, each buoy is interpolated once to the union of the target
+    times instead of to each target separately.
+
+    If tidy is True, returns a long-format dataframe with the columns buoy, target
+    (unless union=True), datetime, <xvar> and <yvar>. Otherwise returns a dictionary
+    of dataframes like those of interpolate_buoy_track_to_reference, keyed by
+    (buoy, target), or by buoy if union=True.
+    """
+    if targets is None:
+        targets = data
+    target_index = {name: pd.DatetimeIndex(targets[name] if isinstance(targets[name], pd.Index)
+                                            else targets[name].index)
+                    for name in targets}
+    if union:
+        union_index = pd.DatetimeIndex([])
+        for name in target_index:
+            union_index = union_index.union(target_index[name])
+        target_index = {'union': union_index}
+    names = list(target_index)
+
+    results = {}
+    for buoy in data:
+        buoy_df = data[buoy]
+        t = buoy_df.index.asi8
+        # Times of all targets within the track, concatenated for one evaluation
+        tnew = [target_index[name][(target_index[name].asi8 >= t.min()) &
+                                   (target_index[name].asi8 <= t.max())] for name in names]
+        sizes = [len(times) for times in tnew]
+        if sum(sizes) > 0:
+            interpolator = get_interpolator(method)((t - t.min()) / 1e9, buoy_df[[xvar, yvar]].values.T)
+            Xnew = interpolator((np.concatenate([times.asi8 for times in tnew]) - t.min()) / 1e9).T
+        else:
+            Xnew = np.zeros((0, 2))
+        for name, times, X in zip(names, tnew, np.split(Xnew, np.cumsum(sizes)[:-1])):
+            df_new = pd.DataFrame(data=np.round(X, 5), columns=[xvar, yvar], index=times)
+            df_new.index.names = ['datetime']
+            results[buoy if union else (buoy, name)] = df_new
+
+    if not tidy:
+        return results
+    keys = ['buoy'] if union else ['buoy', 'target']
+    if len(results) == 0:
+        return pd.DataFrame(columns=keys + ['datetime', xvar, yvar])
+    return pd.concat(results, names=keys).reset_index()
+
 def sic_along_track(position_data, sic_data):
     """Uses the xarray advanced interpolation to get along-track sic
     via nearest neighbors. Nearest neighbors is preferred because numerical
-    flags are used for coasts and open ocean, so interpolation is less meaningful."""
-    
-    # Sea ice concentration uses NSIDC NP Stereographic v1
-    crs0 = pyproj.CRS('WGS84')
-    crs1 = pyproj.CRS('epsg:3411')
-    transformer_stere = pyproj.Transformer.from_crs(crs0, crs_to=crs1, always_xy=True)
-    
-    sic = pd.Series(data=np.nan, index=position_data.index)
+    flags are used for coasts and open ocean, so interpolation is less meaningful.
+
+    The points are looked up in the daily grids with sic_sampler, so position_data
+    can hold any number of buoys, e.g. a long-format frame with a buoy column.
+    Points on days that are missing from sic_data get NaN."""
     
-    for date, group in position_data.groupby(position_data.index.date):
-        x_stere, y_stere = transformer_stere.transform(
-            group.longitude, group.latitude)
-        
-        x = xr.DataArray(x_stere, dims="z")
-        y = xr.DataArray(y_stere, dims="z")
-        SIC = sic_data.sel(time=date.strftime('%Y-%m-%d'))['sea_ice_concentration'].interp(
-            {'x': x,
-             'y': y}, method='nearest').data
-        
-        sic.loc[group.index] = np.round(SIC.T, 3)
+    sample = sic_sampler(sic_data)
+    sic = np.round(sample(position_data.index,
+                          position_data.longitude.values,
+                          position_data.latitude.values), 3)
     
-    sic = pd.DataFrame({'sic_code': sic, 'sic': sic})
+    sic = pd.DataFrame({'sic_code': sic, 'sic': sic}, index=position_data.index)
     sic.loc[sic['sic_code'] > 100, 'sic'] = np.nan
     return sic   
 
+
+def sic_sampler(sic_data, varname='sea_ice_concentration', proj='epsg:3411'):
+    """Returns a function sample(times, lon, lat) that gives the value of <varname>
+    in the grid cell nearest to each point on the day of the point. Sea ice
+    concentration uses NSIDC NP Stereographic v1 (epsg:3411) on a regular grid,
+    so the nearest cell follows from the grid origin and spacing by integer
+    arithmetic, and all points are gathered from the array in one step. Points
+    outside the grid or on days not in sic_data are NaN, as in the xarray nearest
+    interpolation.
+
+    The grid is not copied, so for a memory-mapped dataset (see
+    seaice.open_sic_cache) only the pages holding the sampled cells are read.
+    Cells equal to the fill_value attribute of the variable are NaN. Raises a
+    ValueError if sic_data has no days."""
+    
+    values = sic_data[varname].transpose('time', 'y', 'x').values
+    if values.shape[0] == 0:
+        raise ValueError('sic_sampler needs at least one day of ' + varname +
+                         ', the time axis of sic_data is empty')
+    fill_value = sic_data[varname].attrs.get('fill_value')
+    days = pd.DatetimeIndex(sic_data['time'].values).normalize().asi8
+    x0, dx, x_range = _regular_axis(sic_data['x'].values)
+    y0, dy, y_range = _regular_axis(sic_data['y'].values)
+    n_days, ny, nx = values.shape
+
+    def sample(times, lon, lat):
+        x, y = project(np.asarray(lon), np.asarray(lat), proj)
+        day = pd.DatetimeIndex(times).normalize().asi8
+        k = np.minimum(np.searchsorted(days, day), n_days - 1)
+        with np.errstate(invalid='ignore'):
+            i = np.rint((y - y0) / dy)
+            j = np.rint((x - x0) / dx)
+            ok = (days[k] == day) & \
+                 (x >= x_range[0]) & (x <= x_range[1]) & (y >= y_range[0]) & (y <= y_range[1])
+        out = np.full(len(day), np.nan)
+        out[ok] = values[k[ok], i[ok].astype(int), j[ok].astype(int)]
+        if fill_value is not None:
+            out[out == fill_value] = np.nan
+        return out
+
+    return sample
+
+
+def _regular_axis(coord):
+    """Origin, spacing and (min, max) of an evenly spaced coordinate."""
+    coord = np.asarray(coord, dtype=float)
+    step = np.diff(coord)
+    if len(coord) < 2 or not np.allclose(step, step[0]):
+        raise ValueError('sic_sampler needs evenly spaced x and y coordinates')
+    return coord[0], step[0], (coord.min(), coord.max())
+
+
+# Variables of the track cube, see build_track_cube
+CUBE_VARIABLES = ['longitude', 'latitude', 'x', 'y', 'u', 'v', 'data_gap_minutes']
+
+def build_track_cube(data, freq='1H', maxgap_minutes=120, by_segment=False, path=None):
+    """Interpolates each track in the dictionary <data> (buoy: dataframe with a
+    datetime index and longitude and latitude columns) with interpolate_buoy_track
+    and aligns them on a common time grid. Returns an xarray Dataset with dimensions
+    (buoy, time) and the variables
+    longitude, latitude
+    x, y: north polar stereographic positions in meters
+    u, v: velocity in m/s from analysis.grid_velocity, the same as
+          compute_velocity(method='c') on the aligned rows, with NaN at the ends
+          of each track and next to gaps
+    data_gap_minutes: average time between the original observations
+    with NaN wherever a buoy has no data. Subsets by buoy and time window are
+    views of the arrays, e.g. cube.sel(buoy=buoys, time=slice(start, end)).
+
+    If <path> is given, the arrays are written as .npy files to that directory and
+    the dataset is backed by memory maps of the files, so that a deployment can be
+    built once and reopened with open_track_cube without loading it into memory.
+    """
+    tracks = {}
+    for buoy in data:
+        buoy_df = interpolate_buoy_track(data[buoy], freq=freq, maxgap_minutes=maxgap_minutes,
+                                         by_segment=by_segment)
+        if len(buoy_df) > 0:
+            tracks[buoy] = buoy_df
+
+    buoys = list(tracks)
+    if len(buoys) == 0:
+        time = pd.DatetimeIndex([], name='time')
+    else:
+        time = pd.date_range(min(tracks[b].index[0] for b in buoys),
+                             max(tracks[b].index[-1] for b in buoys), freq=freq, name='time')
+
+    if path is not None:
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'buoy.npy'), np.array(buoys))
+        np.save(os.path.join(path, 'time.npy'), time.asi8)
+    shape = (len(buoys), len(time))
+    arrays = {}
+    for var in CUBE_VARIABLES:
+        if path is None:
+            arrays[var] = np.full(shape, np.nan)
+        else:
+            arrays[var] = np.lib.format.open_memmap(os.path.join(path, var + '.npy'),
+                                                    mode='w+', dtype=float, shape=shape)
+            arrays[var][:] = np.nan
+
+    for i, buoy in enumerate(buoys):
+        buoy_df = tracks[buoy]
+        pos = time.get_indexer(buoy_df.index)
+        for var, col in zip(CUBE_VARIABLES, ['longitude', 'latitude', 'x_stere', 'y_stere',
+                                             None, None, 'data_gap_minutes']):
+            if col is not None:
+                arrays[var][i, pos] = buoy_df[col].values
+        arrays['u'][i], arrays['v'][i] = grid_velocity(time.asi8, arrays['x'][i], arrays['y'][i])
+
+    if path is not None:
+        for var in CUBE_VARIABLES:
+            arrays[var].flush()
+        return open_track_cube(path)
+    return _cube_dataset(buoys, time, arrays)
+
+
+def _cube_dataset(buoys, time, arrays):
+    return xr.Dataset({var: (('buoy', 'time'), arrays[var]) for var in CUBE_VARIABLES},
+                      coords={'buoy': np.array(buoys), 'time': time})
+
+
+def open_track_cube(path):
+    """Opens a track cube written by build_track_cube with memory maps. Data are only
+    read from disk when a subset is used."""
+    buoys = np.load(os.path.join(path, 'buoy.npy'))
+    time = pd.DatetimeIndex(np.load(os.path.join(path, 'time.npy')), name='time')
+    arrays = {var: np.load(os.path.join(path, var + '.npy'), mmap_mode='r')
+              for var in CUBE_VARIABLES}
+    return _cube_dataset(list(buoys), time, arrays)
+
+
+# Sampling intervals (minutes) used to group buoys in benchmark_interpolators
+FREQUENCY_CLASSES = [30, 60, 120, 180, 240, 360, 720]
+
+def frequency_class(index):
+    """Smallest entry of FREQUENCY_CLASSES at least as long as the median time step
+    of the datetime <index>, or the largest entry for sparser tracks."""
+    step = np.median(np.diff(pd.DatetimeIndex(index).asi8)) / 60e9
+    k = np.searchsorted(FREQUENCY_CLASSES, np.round(step), side='left')
+    return FREQUENCY_CLASSES[min(k, len(FREQUENCY_CLASSES) - 1)]
+
+
+def benchmark_interpolators(data, methods=None, holdout=0.1, repeat=3, seed=0):
+    """Compares the interpolators in INTERPOLATORS on the quality controlled tracks in
+    the dictionary <data> (buoy: dataframe with a datetime index and longitude and
+    latitude columns). For each track a random fraction <holdout> of the interior
+    fixes is masked, the remaining fixes are interpolated to the masked times in
+    north polar stereographic coordinates, and the error is the distance to the
+    masked positions.
+
+    Returns a dataframe with one row per buoy and method with the columns
+    buoy, frequency_class (see frequency_class), method, n_masked,
+    rms_error_m: root mean square position error in meters
+    time_s: fastest of <repeat> runs of fitting and evaluating, in seconds
+    peak_memory_kb: peak memory allocated while fitting and evaluating
+    Methods that cannot be used with a track (e.g. too few points) get NaN."""
+    if methods is None:
+        methods = list(INTERPOLATORS)
+    rng = np.random.default_rng(seed)
+    rows = []
+    for buoy in data:
+        buoy_df = data[buoy].dropna(subset=['longitude', 'latitude'])
+        buoy_df = buoy_df[~buoy_df.index.duplicated()].sort_index()
+        if len(buoy_df) < 3:
+            continue
+        X = np.vstack(projected_xy(buoy_df, 'epsg:3413'))
+        t = (buoy_df.index.asi8 - buoy_df.index.asi8[0]) / 1e9
+        interior = np.arange(1, len(t) - 1)
+        masked = np.sort(rng.choice(interior, size=max(int(holdout*len(interior)), 1), replace=False))
+        kept = np.setdiff1d(np.arange(len(t)), masked)
+
+        for method in methods:
+            row = {'buoy': buoy, 'frequency_class': frequency_class(buoy_df.index),
+                   'method': method, 'n_masked': len(masked), 'rms_error_m': np.nan,
+                   'time_s': np.nan, 'peak_memory_kb': np.nan}
+            if len(kept) >= INTERPOLATORS[method][1]:
+                build = get_interpolator(method)
+                timings = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    Xnew = build(t[kept], X[:, kept])(t[masked])
+                    timings.append(time.perf_counter() - start)
+                tracemalloc.start()
+                build(t[kept], X[:, kept])(t[masked])
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                error = np.sqrt(np.sum((Xnew - X[:, masked])**2, axis=0))
+                row.update(rms_error_m=np.sqrt(np.nanmean(error**2)), time_s=min(timings),
+                           peak_memory_kb=peak / 1024)
+            rows.append(row)
+    return pd.DataFrame(rows, columns=['buoy', 'frequency_class', 'method', 'n_masked',
+                                       'rms_error_m', 'time_s', 'peak_memory_kb'])
@@ -0,0 +1,100 @@
+"""Coordinate projections shared by the icedrift modules.
+
+Building a pyproj Transformer is much slower than applying it, so transformers
+are cached per pair of coordinate reference systems and reused by every function
+that projects positions. A buoy track can also carry its projected coordinates as
+columns (see XY_COLUMNS), which later stages can use with use_xy=True instead of
+projecting the track again. The counters in projection_stats show how often the
+cache and the carried coordinates were used during a run.
+
+The projections used in the package are
+epsg:4326 WGS 84 longitude and latitude
+epsg:3413 NSIDC Polar Stereographic, for positions and velocities
+epsg:3411 NSIDC Polar Stereographic (Hughes 1980 ellipsoid), used by the sea ice concentration grids
+epsg:6931 NSIDC EASE 2.0 Lambert Azimuthal Equal Area, for area calculations
+"""
+import numpy as np
+import pyproj
+
+LONLAT = 'epsg:4326'
+
+# Columns used to carry projected coordinates on a buoy track
+XY_COLUMNS = {'epsg:3413': ('x', 'y'),
+              'epsg:3411': ('x_3411', 'y_3411'),
+              'epsg:6931': ('x_laea', 'y_laea')}
+
+_transformers = {}
+_stats = {'hits': 0, 'misses': 0, 'projected': 0, 'reused': 0}
+
+
+def _crs_key(crs):
+    """Normalized name of a CRS given as a string or a pyproj.CRS. A pyproj.CRS is
+    named by its EPSG code if it has one, and by its definition otherwise."""
+    if isinstance(crs, pyproj.CRS):
+        epsg = crs.to_epsg()
+        if epsg is None:
+            return crs.srs
+        crs = 'epsg:' + str(epsg)
+    crs = str(crs).lower()
+    if crs == 'wgs84':
+        crs = LONLAT
+    return crs
+
+
+def get_transformer(crs_from, crs_to):
+    """Returns a transformer from crs_from to crs_to with x/y (longitude/latitude)
+    axis order, building it on first use."""
+    key = (_crs_key(crs_from), _crs_key(crs_to))
+    if key in _transformers:
+        _stats['hits'] += 1
+    else:
+        _stats['misses'] += 1
+        _transformers[key] = pyproj.Transformer.from_crs(key[0], key[1], always_xy=True)
+    return _transformers[key]
+
+
+def project(lon, lat, crs='epsg:3413'):
+    """Projects longitude and latitude to x and y in <crs>. Returns float arrays."""
+    x, y = get_transformer(LONLAT, crs).transform(lon, lat)
+    _stats['projected'] += 1
+    return np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+
+
+def unproject(x, y, crs='epsg:3413'):
+    """Inverse of project: returns longitude and latitude arrays."""
+    lon, lat = get_transformer(crs, LONLAT).transform(x, y)
+    return np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+
+
+def projected_xy(buoy_df, crs='epsg:3413', use_xy=False):
+    """Returns the x and y positions of <buoy_df> in <crs>, projecting the longitude
+    and latitude. With use_xy=True, the columns named in XY_COLUMNS are used
+    instead if the track carries them, which assumes they hold the positions in
+    <crs> (e.g. as added by add_xy). CRSs without an entry in XY_COLUMNS are always
+    projected."""
+    xvar, yvar = XY_COLUMNS.get(_crs_key(crs), (None, None))
+    if use_xy and xvar in buoy_df.columns and yvar in buoy_df.columns:
+        _stats['reused'] += 1
+        return buoy_df[xvar].values, buoy_df[yvar].values
+    return project(buoy_df['longitude'].values, buoy_df['latitude'].values, crs)
+
+
+def add_xy(buoy_df, crs='epsg:3413'):
+    """Adds the projected positions in <crs> to <buoy_df> as the columns named in
+    XY_COLUMNS, so that later stages can reuse them. Modifies buoy_df in place
+    and returns it."""
+    xvar, yvar = XY_COLUMNS[_crs_key(crs)]
+    buoy_df[xvar], buoy_df[yvar] = projected_xy(buoy_df, crs)
+    return buoy_df
+
+
+def projection_stats():
+    """Counts since the last reset: transformer cache hits and misses, calls that
+    projected positions, and calls that reused the coordinates carried by a track."""
+    return dict(_stats)
+
+
+def reset_projection_stats():
+    """Sets the counters in projection_stats back to zero. Cached transformers are kept."""
+    for key in _stats:
+        _stats[key] = 0
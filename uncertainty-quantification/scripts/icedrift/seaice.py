@@ -0,0 +1,183 @@
+"""Local cache of the daily sea ice concentration grids.
+
+Decoding the sea ice concentration NetCDF takes much longer than the analyses
+that use it, and every process that opens it holds its own copy of the array. The
+cache converts the grids once into a uint8 cube stored as a .npy file, with the
+times and the x and y coordinates in their own index files, next to the NetCDF
+file. open_sic_cache returns an xarray Dataset backed by memory maps of these
+files, so day slices and point lookups (see interpolation.sic_sampler) only read
+the pages they touch, and repeated runs and parallel workers share one copy
+through the operating system page cache.
+
+Concentrations are stored as whole percentages with the numerical flags for
+land, coast and missing data (values above 100) kept as they are. Missing values
+(NaN in the NetCDF) are stored as FILL_VALUE, which is recorded in the attributes
+of the variable so that readers can mask it.
+"""
+import json
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+FILL_VALUE = 255
+
+
+def _cache_files(cache_dir, varname):
+    return {'values': os.path.join(cache_dir, varname + '.npy'),
+            'time': os.path.join(cache_dir, 'time.npy'),
+            'x': os.path.join(cache_dir, 'x.npy'),
+            'y': os.path.join(cache_dir, 'y.npy'),
+            'meta': os.path.join(cache_dir, 'meta.json')}
+
+
+def _source_meta(nc_path, varname):
+    """Identifies the version of the source file the cache was built from."""
+    stat = os.stat(nc_path)
+    return {'source': os.path.abspath(nc_path), 'size': stat.st_size,
+            'mtime': stat.st_mtime, 'varname': varname, 'fill_value': FILL_VALUE}
+
+
+def _cache_is_current(files, meta):
+    if not all(os.path.exists(f) for f in files.values()):
+        return False
+    with open(files['meta']) as f:
+        return json.load(f) == meta
+
+
+def _save(path, array):
+    """Writes <array> to a temporary file and moves it into place, so that another
+    process never sees a partly written file."""
+    tmp = '{}.{}.tmp.npy'.format(path[:-4], os.getpid())
+    np.save(tmp, array)
+    os.replace(tmp, path)
+
+
+def build_sic_cache(nc_path, cache_dir, varname='sea_ice_concentration'):
+    """Converts <varname> in the NetCDF file <nc_path> to the uint8 cube and index
+    files in <cache_dir>. The grids are converted one day at a time, so the full
+    array is never held in memory. Raises a ValueError if the data are not whole
+    numbers between 0 and 254."""
+    os.makedirs(cache_dir, exist_ok=True)
+    files = _cache_files(cache_dir, varname)
+    with xr.open_dataset(nc_path) as sic_data:
+        sic = sic_data[varname].transpose('time', 'y', 'x')
+        tmp = '{}.{}.tmp.npy'.format(files['values'][:-4], os.getpid())
+        cube = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8, shape=sic.shape)
+        for k in range(sic.shape[0]):
+            day = np.asarray(sic[k].values, dtype=float)
+            missing = np.isnan(day)
+            day = np.where(missing, FILL_VALUE, day)
+            if np.any(day != np.round(day)) or np.any(day < 0) or np.any(day[~missing] >= FILL_VALUE):
+                del cube
+                os.remove(tmp)
+                raise ValueError('{} on {} is not stored as whole numbers 0-254, '
+                                 'it cannot be cached as uint8'.format(varname, sic['time'].values[k]))
+            cube[k] = day.astype(np.uint8)
+        cube.flush()
+        del cube
+        os.replace(tmp, files['values'])
+        _save(files['time'], pd.DatetimeIndex(sic['time'].values).asi8)
+        _save(files['x'], np.asarray(sic['x'].values, dtype=float))
+        _save(files['y'], np.asarray(sic['y'].values, dtype=float))
+
+    # The metadata file is written last and marks the cache as complete
+    tmp = files['meta'] + '.{}.tmp'.format(os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(_source_meta(nc_path, varname), f)
+    os.replace(tmp, files['meta'])
+
+
+def open_sic_cache(nc_path, cache_dir=None, varname='sea_ice_concentration'):
+    """Opens the sea ice concentration in <nc_path> through the memory-mapped cache,
+    building the cache first if it is missing or older than the NetCDF file. By
+    default the cache is the directory <nc_path without extension>_cache. Returns
+    an xarray Dataset with <varname> as a uint8 (time, y, x) array. Missing values
+    are FILL_VALUE, given by the fill_value attribute of the variable.
+
+    Example
+    sic_data = open_sic_cache("../data/sea_ice_concentration/amsr2_sea_ice_concentration.nc")
+    """
+    if cache_dir is None:
+        cache_dir = os.path.splitext(nc_path)[0] + '_cache'
+    files = _cache_files(cache_dir, varname)
+    if not _cache_is_current(files, _source_meta(nc_path, varname)):
+        build_sic_cache(nc_path, cache_dir, varname)
+    return load_sic_cache(cache_dir, varname)
+
+
+def load_sic_cache(cache_dir, varname='sea_ice_concentration'):
+    """Opens an existing cache written by build_sic_cache without checking it
+    against the source file."""
+    files = _cache_files(cache_dir, varname)
+    values = np.load(files['values'], mmap_mode='r')
+    time = pd.DatetimeIndex(np.load(files['time']), name='time')
+    sic = xr.DataArray(values, dims=('time', 'y', 'x'), attrs={'fill_value': FILL_VALUE})
+    return xr.Dataset({varname: sic},
+                      coords={'time': time, 'y': np.load(files['y']), 'x': np.load(files['x'])})
+
+
+def nearest_sic(sic, times, x, y):
+    """Values of the DataArray <sic> at the grid cells and days nearest to each
+    point, the same as sic.sel(time=time, x=x, y=y, method='nearest') point by point
+    but gathered from the array in one step. Points with a missing time or position
+    are NaN, as are cells equal to the fill_value attribute of <sic>."""
+    values = sic.transpose('time', 'y', 'x').values
+    k = sic.indexes['time'].get_indexer(pd.DatetimeIndex(times), method='nearest')
+    i = sic.indexes['y'].get_indexer(np.asarray(y, dtype=float), method='nearest')
+    j = sic.indexes['x'].get_indexer(np.asarray(x, dtype=float), method='nearest')
+    ok = (k >= 0) & (i >= 0) & (j >= 0)
+    out = np.full(len(k), np.nan)
+    out[ok] = values[k[ok], i[ok], j[ok]]
+    fill_value = sic.attrs.get('fill_value')
+    if fill_value is not None:
+        out[out == fill_value] = np.nan
+    return out
+
+
+def sic_cutoffs(tracks, sic, thresholds=(15,), start=None, end=None,
+                dt='datetime', x='x_stere', y='y_stere'):
+    """Finds for each track in the dictionary <tracks> (buoy: dataframe with columns
+    <dt>, <x> and <y>) the first time between <start> and <end> (exclusive) at which
+    the sea ice concentration in <sic> drops below each of the <thresholds>. The
+    concentration along all tracks is sampled at once with nearest_sic. If it never
+    drops below a threshold, the cutoff is the last time of the track.
+
+    Returns a dataframe indexed by buoy_id with a column cutoff_<threshold> for each
+    threshold, plus a column cutoff for the first threshold."""
+    thresholds = list(thresholds)
+    buoys = list(tracks)
+    windows = []
+    for buoy in buoys:
+        track = tracks[buoy]
+        keep = np.ones(len(track), dtype=bool)
+        if start is not None:
+            keep &= (track[dt] > pd.to_datetime(start)).values
+        if end is not None:
+            keep &= (track[dt] < pd.to_datetime(end)).values
+        windows.append(track.loc[keep, [dt, x, y]])
+    sizes = np.array([len(w) for w in windows])
+    last = pd.DatetimeIndex([tracks[b][dt].iloc[-1] for b in buoys])
+    result = pd.DataFrame(index=pd.Index(buoys, name='buoy_id'))
+
+    points = pd.concat(windows) if len(windows) > 0 else pd.DataFrame(columns=[dt, x, y])
+    conc = nearest_sic(sic, points[dt].values, points[x].values, points[y].values)
+    times = pd.DatetimeIndex(points[dt].values).asi8
+    offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(int)
+    n = len(conc)
+    has_points = sizes > 0
+    for threshold in thresholds:
+        with np.errstate(invalid='ignore'):
+            below = conc < threshold
+        # Position of the first point below the threshold in each track, n if none
+        first = np.where(below, np.arange(n), n)
+        crossing = np.full(len(buoys), n)
+        if has_points.any():
+            crossing[has_points] = np.minimum.reduceat(first, offsets[has_points])
+        crossed = has_points & (crossing < offsets + sizes)
+        cutoff = last.asi8.copy()
+        cutoff[crossed] = times[crossing[crossed]]
+        result['cutoff_{:g}'.format(threshold)] = pd.DatetimeIndex(cutoff)
+    if len(thresholds) > 0:
+        result.insert(0, 'cutoff', result['cutoff_{:g}'.format(thresholds[0])])
+    return result
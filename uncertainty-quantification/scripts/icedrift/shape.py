@@ -0,0 +1,128 @@
+"""Shape screening for buoy polygons.
+
+Strain rates from a polygon of buoys are unreliable when the polygon is very
+small, thin, has a nearly flat angle or is not convex. The functions here compute
+shape measures for many polygons over time in one pass, with the vertices along
+axis -2 and time along the last axis, so that deformation calculations can leave
+out badly shaped polygons before computing their strain rates. The vertices can
+be in either order, as in analysis.strain_rate_arrays.
+
+Measures, computed in polar stereographic coordinates (meters)
+signed_area: positive for counter-clockwise vertices
+min_angle, max_angle: smallest and largest interior angle in degrees, above 180
+                      at the reflex vertex of a non-convex polygon
+aspect_ratio: square root of the ratio of the largest to the smallest principal
+              variance of the vertex positions, 1 for regular polygons
+perimeter_ratio: perimeter divided by the square root of the area, about 4.56 for
+                 an equilateral triangle and 4 for a square
+"""
+import numpy as np
+import pandas as pd
+import xarray as xr
+from icedrift.projection import project
+
+
+def signed_area(X, Y):
+    """Signed area of polygons with the vertices along axis -2, positive for
+    counter-clockwise order."""
+    return 0.5 * np.sum(X*np.roll(Y, -1, axis=-2) - Y*np.roll(X, -1, axis=-2), axis=-2)
+
+
+def interior_angles(X, Y):
+    """Interior angles in degrees (0 to 360) at each vertex of polygons with the
+    vertices along axis -2, in either order. The angle from the next edge to the
+    previous one is measured in the direction the vertices go around."""
+    ex, ey = np.roll(X, -1, axis=-2) - X, np.roll(Y, -1, axis=-2) - Y
+    fx, fy = np.roll(X, 1, axis=-2) - X, np.roll(Y, 1, axis=-2) - Y
+    orientation = np.expand_dims(np.where(signed_area(X, Y) < 0, -1, 1), -2)
+    return np.degrees(np.arctan2(orientation*(ex*fy - ey*fx), ex*fx + ey*fy)) % 360
+
+
+def min_angle(X, Y):
+    """Smallest interior angle in degrees of polygons with the vertices along axis -2."""
+    return interior_angles(X, Y).min(axis=-2)
+
+
+def polygon_metrics(X, Y):
+    """Shape measures (see the module docstring) of polygons with the vertices along
+    axis -2 of X and Y. Returns a dictionary of arrays with the vertex axis removed."""
+    A = signed_area(X, Y)
+    angles = interior_angles(X, Y)
+
+    dx, dy = X - X.mean(axis=-2, keepdims=True), Y - Y.mean(axis=-2, keepdims=True)
+    sxx, syy, sxy = (dx**2).mean(axis=-2), (dy**2).mean(axis=-2), (dx*dy).mean(axis=-2)
+    # Eigenvalues of the 2x2 covariance matrix
+    half_trace = (sxx + syy) / 2
+    root = np.sqrt(((sxx - syy) / 2)**2 + sxy**2)
+    perimeter = np.sum(np.hypot(np.roll(X, -1, axis=-2) - X, np.roll(Y, -1, axis=-2) - Y), axis=-2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        aspect_ratio = np.sqrt((half_trace + root) / (half_trace - root))
+        perimeter_ratio = perimeter / np.sqrt(np.abs(A))
+
+    return {'signed_area': A,
+            'min_angle': angles.min(axis=-2),
+            'max_angle': angles.max(axis=-2),
+            'aspect_ratio': aspect_ratio,
+            'perimeter_ratio': perimeter_ratio}
+
+
+def shape_mask(metrics, min_angle_deg=20, min_area=0, max_area=None,
+               max_aspect_ratio=None, max_perimeter_ratio=None, max_angle_deg=180):
+    """True where the polygons in <metrics> (see polygon_metrics), in either vertex
+    order, have an area above min_area (m^2), all interior angles between
+    min_angle_deg and max_angle_deg (by default only convex polygons pass), and pass
+    the other limits that are given."""
+    area = np.abs(metrics['signed_area'])
+    with np.errstate(invalid='ignore'):
+        valid = (area > min_area) & (metrics['min_angle'] >= min_angle_deg) & \
+                (metrics['max_angle'] < max_angle_deg)
+        if max_area is not None:
+            valid &= area <= max_area
+        if max_aspect_ratio is not None:
+            valid &= metrics['aspect_ratio'] <= max_aspect_ratio
+        if max_perimeter_ratio is not None:
+            valid &= metrics['perimeter_ratio'] <= max_perimeter_ratio
+    return valid
+
+
+def screen_polygons(polygons, cube, min_angle_deg=20, min_area=0, max_area=None,
+                    max_aspect_ratio=None, max_perimeter_ratio=None, max_angle_deg=180,
+                    chunk_size=1000):
+    """Shape measures and validity of polygons of buoys in the track cube <cube> (see
+    interpolation.build_track_cube), given as a list of lists of buoy labels, at every
+    time step. The limits are those of shape_mask. Polygons with the same number of
+    vertices are evaluated together, <chunk_size> at a time.
+
+    Returns an xarray Dataset with dimensions (polygon, time) holding the measures of
+    polygon_metrics and the boolean 'valid' mask, which can be passed to
+    analysis.compute_strain_rate_batch, and the coordinate 'vertices' as in
+    compute_strain_rate_batch."""
+    buoys = list(cube['buoy'].values)
+    time = pd.DatetimeIndex(cube['time'].values)
+    if 'x' in cube and 'y' in cube:
+        X, Y = cube['x'].values, cube['y'].values
+    else:
+        lon, lat = cube['longitude'].values, cube['latitude'].values
+        X, Y = [a.reshape(lon.shape) for a in project(lon.ravel(), lat.ravel(), 'epsg:3413')]
+
+    position = {b: i for i, b in enumerate(buoys)}
+    names = ['signed_area', 'min_angle', 'max_angle', 'aspect_ratio', 'perimeter_ratio']
+    out = {name: np.full((len(polygons), len(time)), np.nan) for name in names}
+    valid = np.zeros((len(polygons), len(time)), dtype=bool)
+    sizes = np.array([len(p) for p in polygons])
+    for n in np.unique(sizes):
+        rows = np.flatnonzero(sizes == n)
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            idx = np.array([[position[b] for b in polygons[k]] for k in chunk])
+            metrics = polygon_metrics(X[idx], Y[idx])
+            for name in names:
+                out[name][chunk] = metrics[name]
+            valid[chunk] = shape_mask(metrics, min_angle_deg, min_area, max_area,
+                                      max_aspect_ratio, max_perimeter_ratio, max_angle_deg)
+
+    data = {name: (('polygon', 'time'), out[name]) for name in names}
+    data['valid'] = (('polygon', 'time'), valid)
+    vertices = ['-'.join(str(b) for b in p) for p in polygons]
+    return xr.Dataset(data, coords={'polygon': np.arange(len(polygons)), 'time': time,
+                                    'vertices': ('polygon', vertices)})
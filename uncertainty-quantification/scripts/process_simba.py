@@ -4,6 +4,7 @@ import numpy as np
 import os
 from scipy.interpolate import interp1d
 from helpers import *
+from icedrift.interpolation import get_interpolator
 
 dataloc = '../data/simba_data/raw/'
 saveloc = '../data/simba_data/clean/'
@@ -46,10 +47,12 @@ aux_data = {buoy: aux_data[buoy] for buoy in aux_data if 'Compass bearing [deg]'
 ####
 
 def interpolate_rotation(buoy_df, cpvar='Compass bearing [deg]', 
-                           freq='1H', maxgap_minutes=120):
+                           freq='1H', maxgap_minutes=120, method='cubic'):
     """Applies interp1d with cubic splines to the rotation specified by cpvar. 
     Assumes that the dataframe buoy_df has a datetime index. Frequency should 
     be in a form understandable to pandas date_range, e.g. '1H' for hourly.
+    Other interpolators can be chosen by name with <method>, see
+    icedrift.interpolation.INTERPOLATORS.
     """
 
     buoy_df = buoy_df.dropna(subset=[cpvar]).copy()
@@ -67,7 +70,7 @@ def interpolate_rotation(buoy_df, cpvar='Compass bearing [deg]',
     time_till_next = time_till_next.dt.total_seconds()
     time_since_last = time_since_last.dt.total_seconds()
 
-    Xnew = interp1d(dt, X.values, bounds_error=False, kind='cubic')(dtnew).T
+    Xnew = get_interpolator(method)(dt.values, X.values)(dtnew.values).T
 
     # add information on initial time resolution 
     data_gap = interp1d(dt, np.sum(np.array([time_till_next.fillna(0),
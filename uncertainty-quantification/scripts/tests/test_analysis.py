@@ -0,0 +1,53 @@
+import tracemalloc
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from icedrift.analysis import strain_rate_ensemble
+
+
+def make_cube(n_buoys=4, n_times=30, freq='3h', seed=0):
+    rng = np.random.default_rng(seed)
+    angle = np.linspace(0, 2*np.pi, n_buoys, endpoint=False)
+    lat = 80 + 0.1*np.sin(angle)[:, None] + np.cumsum(rng.standard_normal((n_buoys, n_times)), axis=1)*1e-3
+    lon = 10 + 0.5*np.cos(angle)[:, None] + np.cumsum(rng.standard_normal((n_buoys, n_times)), axis=1)*5e-3
+    lat[2, 10:13] = np.nan
+    lon[2, 10:13] = np.nan
+    return xr.Dataset({'longitude': (('buoy', 'time'), lon), 'latitude': (('buoy', 'time'), lat)},
+                      coords={'buoy': ['B{}'.format(i) for i in range(n_buoys)],
+                              'time': pd.date_range('2020-01-01', periods=n_times, freq=freq)})
+
+
+def test_ensemble_without_noise_matches_base():
+    cube = make_cube()
+    ens = strain_rate_ensemble([['B0', 'B1', 'B2'], ['B0', 'B1', 'B2', 'B3']], cube,
+                               n_members=3, position_uncertainty=0)
+    for name in ['divergence', 'vorticity', 'area']:
+        np.testing.assert_allclose(ens['mean_' + name], ens[name], rtol=1e-9)
+        np.testing.assert_array_equal(np.isnan(ens['mean_' + name]), np.isnan(ens[name]))
+
+
+def test_ensemble_needs_two_members():
+    with pytest.raises(ValueError):
+        strain_rate_ensemble([['B0', 'B1', 'B2']], make_cube(), n_members=1)
+
+
+def test_ensemble_does_not_depend_on_memory_cap():
+    cube = make_cube(n_buoys=5)
+    polygons = [['B0', 'B1', 'B2'], ['B1', 'B3', 'B4'], ['B0', 'B1', 'B2', 'B3']]
+    # 0.05 MB splits the members into blocks and the time steps into windows
+    small = strain_rate_ensemble(polygons, cube, n_members=50, max_memory_mb=0.05)
+    large = strain_rate_ensemble(polygons, cube, n_members=50, max_memory_mb=512)
+    for var in large.data_vars:
+        np.testing.assert_allclose(small[var], large[var], rtol=1e-12, err_msg=var)
+
+
+def test_ensemble_memory_is_bounded():
+    cube = make_cube(n_buoys=6, n_times=2000, freq='1h')
+    polygons = [['B0', 'B1', 'B2'], ['B3', 'B4', 'B5'], ['B0', 'B2', 'B3', 'B5']]
+    tracemalloc.start()
+    strain_rate_ensemble(polygons, cube, n_members=200, max_memory_mb=8)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # The results of all members of one polygon alone would take about 25 MB
+    assert peak < 12 * 2**20
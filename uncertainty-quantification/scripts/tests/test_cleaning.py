@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+import pytest
+from icedrift.analysis import compute_velocity
+from icedrift.cleaning import qc_mask, qc_mask_batch, QC_SIZE, QC_SPEED, check_position_splines, \
+    check_speed, standard_qc
+
+
+def make_buoy(n=400, freq='60min', seed=0, spikes=4, gap=None):
+    """Random walk track with position spikes and, optionally, a gap of the
+    observations in the slice <gap>."""
+    rng = np.random.default_rng(seed)
+    t = pd.date_range('2020-01-01', periods=n, freq=freq)
+    lat = 80 + np.cumsum(rng.standard_normal(n))*0.002
+    lon = 10 + seed + np.cumsum(rng.standard_normal(n))*0.01
+    lon[rng.choice(np.arange(20, n - 20), size=spikes, replace=False)] += 0.2
+    df = pd.DataFrame({'latitude': lat, 'longitude': lon}, index=t)
+    if gap is not None:
+        df = df.drop(df.index[gap])
+    return df
+
+
+def baseline_check_speed(buoy_df, window='3day', sigma=5, max_speed=1.5):
+    """check_speed as it was before the array version, with pandas rolling windows
+    and a full recomputation for every leave-one-out update. Returns the flags."""
+    window = pd.to_timedelta(window)
+    n_min = 0.4*buoy_df.rolling(window, center=True).count()['latitude'].median()
+    n_min = int(n_min) if n_min > 0 else 10
+
+    def zscore(df):
+        scores = []
+        for c in ['u', 'v']:
+            rolled = df[c].rolling(window, center=True, min_periods=n_min)
+            score = (df[c] - rolled.mean()) / rolled.std()
+            scores.append(score - score.rolling(window, center=True, min_periods=n_min).median())
+        return scores
+
+    df = compute_velocity(buoy_df, date_index=True, method='fb')
+    zu, zv = zscore(df)
+    for date in df.index:
+        if (np.abs(zu[date]) > 3) | (np.abs(zv[date]) > 3):
+            idx = df.index[np.abs(df.index - date) < (1.5*window)].drop(date)
+            zu_idx, zv_idx = zscore(compute_velocity(df.drop(date).loc[idx, :], method='fb'))
+            idx = zu_idx.index[np.abs(zu_idx.index - date) < (0.5*window)]
+            zu.loc[idx] = zu_idx.loc[idx]
+            zv.loc[idx] = zv_idx.loc[idx]
+
+    flag = df.u.notnull() & ((np.abs(zu) > sigma) | (np.abs(zv) > sigma))
+    df = compute_velocity(buoy_df.loc[~flag], method='fb')
+    if np.any(df.speed > max_speed):
+        flag = flag | (df.speed > max_speed)
+    return flag
+
+
+def make_speed_track():
+    """Hourly track with spikes, a short and a long gap, and a stretch of erratic
+    positions in which every observation is too fast."""
+    track = make_buoy(n=24*20, spikes=8)
+    rng = np.random.default_rng(5)
+    track.iloc[300:306, 1] += rng.uniform(0.5, 1, 6) * np.array([1, -1, 1, -1, 1, -1])
+    return track.drop(track.index[100:112]).drop(track.index[200:248])
+
+
+def test_check_speed_matches_baseline():
+    track = make_speed_track()
+    expected = baseline_check_speed(track, window='1D', sigma=4).values
+    erratic = track.index.get_indexer(pd.date_range('2020-01-13 12:00', periods=6, freq='1h'))
+    assert expected[erratic].all()
+    assert 0 < expected.sum() < len(track) // 10
+    for chunk_size in [None, 7, 50]:
+        flag = check_speed(track, window='1D', sigma=4, chunk_size=chunk_size)
+        np.testing.assert_array_equal(flag.values, expected, err_msg=str(chunk_size))
+
+
+def test_standard_qc_chunks():
+    track = make_speed_track()
+    qc = standard_qc(track, lat_range=(50, 90), speed_window='1D')
+    speed_checked = track.loc[(qc['qc_mask'] & ~QC_SPEED) == 0]
+    expected = baseline_check_speed(speed_checked, window='1D', sigma=4)
+    np.testing.assert_array_equal(qc.loc[speed_checked.index, 'qc_mask'] == QC_SPEED, expected.values)
+    for chunk_size in [7, 50]:
+        pd.testing.assert_frame_equal(standard_qc(track, lat_range=(50, 90), speed_window='1D',
+                                                  chunk_size=chunk_size), qc)
+
+
+def test_qc_mask_batch_matches_qc_mask():
+    buoys = {'A': make_buoy(seed=0),
+             'B': make_buoy(seed=1, gap=slice(200, 210)),
+             'C': make_buoy(n=50, seed=2),
+             'D': make_buoy(n=300, freq='30min', seed=3, spikes=6)}
+    # Repeated time and repeated position
+    buoys['A'].index = buoys['A'].index.where(np.arange(400) != 50, buoys['A'].index[49])
+    buoys['D'].iloc[100] = buoys['D'].iloc[99]
+    gap_threshold = pd.Series({'A': '180min', 'B': '180min', 'C': '180min', 'D': '90min'})
+
+    data = pd.concat([df.assign(buoy=b) for b, df in buoys.items()])
+    mask = qc_mask_batch(data['buoy'].values, data.index, data['latitude'].values,
+                         data['longitude'].values, lat_range=(50, 90),
+                         gap_threshold=pd.to_timedelta(gap_threshold))
+    for b, df in buoys.items():
+        expected = qc_mask(df.index, df['latitude'].values, df['longitude'].values,
+                           lat_range=(50, 90), gap_threshold=gap_threshold[b])
+        np.testing.assert_array_equal(mask[(data['buoy'] == b).values], expected, err_msg=b)
+    assert np.all(mask[(data['buoy'] == 'C').values] & QC_SIZE)
+    assert np.any(mask[(data['buoy'] == 'A').values] == 0)
+
+
+def test_spline_methods_agree():
+    pytest.importorskip('patsy')
+    pytest.importorskip('sklearn')
+    rng = np.random.default_rng(0)
+    n = 24*12
+    seconds = np.arange(n)*3600.
+    data = pd.DataFrame({'x': 2e4*np.sin(2*np.pi*seconds/5e5) + 0.1*seconds + rng.normal(0, 50, n),
+                         'y': 1e4*np.cos(2*np.pi*seconds/7e5) + rng.normal(0, 50, n)},
+                        index=pd.date_range('2020-01-01', periods=n, freq='1h'))
+    spikes = [40, 90, 150, 200, 250]
+    data.iloc[spikes, 0] += 3000
+    data.iloc[spikes[::2], 1] -= 2000
+
+    for method in ['refit', 'hat']:
+        flag = check_position_splines(data.copy(), 'x', 'y', df=10, fit_window='24h', sigma=8,
+                                      method=method)
+        np.testing.assert_array_equal(np.flatnonzero(flag), spikes, err_msg=method)
+        # sigma is honoured: nothing is that far off
+        flag = check_position_splines(data.copy(), 'x', 'y', df=10, fit_window='24h', sigma=1e3,
+                                      method=method)
+        assert not flag.any(), method
@@ -0,0 +1,40 @@
+import numpy as np
+from icedrift.dispersion import absolute_dispersion, relative_dispersion
+
+
+def make_velocities(n_buoys=12, n_times=48, seed=0):
+    rng = np.random.default_rng(seed)
+    u = 0.1 + 0.05*rng.standard_normal((n_buoys, n_times))
+    v = -0.05 + 0.05*rng.standard_normal((n_buoys, n_times))
+    u[3, 20:] = np.nan
+    return u, v, rng.uniform(0, 100e3, n_buoys), rng.uniform(0, 100e3, n_buoys)
+
+
+def test_relative_dispersion_brute_force_and_blocks():
+    u, v, x0, y0 = make_velocities()
+    bins = (0, 50e3, 150e3)
+    result = relative_dispersion(u, v, x0, y0, bins=bins, n_boot=20)
+    small = relative_dispersion(u, v, x0, y0, bins=bins, n_boot=20, max_memory_mb=0.01)
+    for var in result:
+        np.testing.assert_allclose(result[var], small[var], rtol=1e-9)
+
+    X = np.zeros(u.shape)
+    Y = np.zeros(v.shape)
+    X[:, 1:], Y[:, 1:] = np.cumsum(u[:, 1:]*3600, axis=1), np.cumsum(v[:, 1:]*3600, axis=1)
+    total, count = np.zeros((2, u.shape[1])), np.zeros((2, u.shape[1]))
+    for i in range(len(u)):
+        for j in range(i + 1, len(u)):
+            k = np.digitize(np.hypot(x0[i] - x0[j], y0[i] - y0[j]), bins) - 1
+            change = (X[i] - X[j])**2 + (Y[i] - Y[j])**2
+            ok = np.isfinite(change)
+            total[k, ok] += change[ok]
+            count[k, ok] += 1
+    np.testing.assert_array_equal(result['n_pairs'], count)
+    np.testing.assert_allclose(result['dispersion'], total / count, rtol=1e-9)
+
+
+def test_absolute_dispersion_blocks():
+    u, v, x0, y0 = make_velocities()
+    result = absolute_dispersion(u, v, n_boot=20)
+    small = absolute_dispersion(u, v, n_boot=20, max_memory_mb=0.01)
+    np.testing.assert_allclose(result.values, small.values, rtol=1e-9)
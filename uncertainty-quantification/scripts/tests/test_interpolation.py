@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from icedrift.analysis import compute_velocity, cube_kinematics
+from icedrift.interpolation import build_track_cube, regrid_buoy_track, get_interpolator, \
+    sic_sampler, INTERPOLATORS
+
+
+def make_track(n=200, freq='30min', seed=0, start='2020-01-01', gap=None):
+    rng = np.random.default_rng(seed)
+    t = pd.date_range(start, periods=n, freq=freq)
+    df = pd.DataFrame({'latitude': 80 + np.cumsum(rng.standard_normal(n))*0.002,
+                       'longitude': 10 + np.cumsum(rng.standard_normal(n))*0.01},
+                      index=pd.DatetimeIndex(t, name='datetime'))
+    if gap is not None:
+        df = df.drop(df.index[gap[0]:gap[1]])
+    return df
+
+
+def test_cube_velocity_matches_compute_velocity():
+    data = {'A': make_track(seed=0, gap=(60, 80)),
+            'B': make_track(seed=1, start='2020-01-01 05:00', gap=(100, 104)),
+            'C': make_track(seed=2, n=50)}
+    cube = build_track_cube(data, freq='1h')
+    X, Y, XA, YA, U, V = cube_kinematics(cube)
+    for i, buoy in enumerate(cube['buoy'].values):
+        row = cube.isel(buoy=i).to_dataframe()[['x', 'y', 'u', 'v']]
+        expected = compute_velocity(row[['x', 'y']], method='c')
+        np.testing.assert_array_equal(row['u'], expected['u'])
+        np.testing.assert_array_equal(row['v'], expected['v'])
+        # cube_kinematics differences the projected longitude and latitude, which
+        # differ slightly from the interpolated x and y, with the same convention
+        np.testing.assert_array_equal(np.isnan(U[i]), np.isnan(cube['u'].values[i]))
+        np.testing.assert_array_equal(np.isnan(V[i]), np.isnan(cube['v'].values[i]))
+
+
+def test_regrid_keeps_times():
+    # The output is on the input times, not rounded to <precision>
+    track = make_track(n=100, freq='17min')
+    regrid = regrid_buoy_track(track, precision='5min')
+    pd.testing.assert_index_equal(pd.DatetimeIndex(regrid.index), pd.DatetimeIndex(track.index),
+                                  check_names=False)
+    np.testing.assert_allclose(regrid['longitude'], track['longitude'], atol=1e-5)
+    np.testing.assert_allclose(regrid['latitude'], track['latitude'], atol=1e-5)
+    # The regridded positions stay within a few meters of the track
+    assert np.nanmax(regrid['sigma_x_regrid']) < 100
+
+
+def test_interpolators_accept_unsorted_and_repeated_times():
+    t = np.array([0., 2., 1., 3., 4., 4., 5., 6.])
+    X = np.vstack([t**2, t])
+    for method in INTERPOLATORS:
+        expected = get_interpolator(method)(np.arange(7.), np.vstack([np.arange(7.)**2, np.arange(7.)]))
+        np.testing.assert_allclose(get_interpolator(method)(t, X)([0.5, 2.5, 5.5]),
+                                   expected([0.5, 2.5, 5.5]))
+
+
+def make_sic(days):
+    time = pd.date_range('2020-01-01', periods=days, freq='D')
+    x = np.arange(-500e3, 500e3, 25e3)
+    y = np.arange(-500e3, 500e3, 25e3)
+    values = np.full((days, len(y), len(x)), 90.)
+    return xr.Dataset({'sea_ice_concentration': (('time', 'y', 'x'), values)},
+                      coords={'time': time, 'y': y, 'x': x})
+
+
+def test_sic_sampler():
+    sample = sic_sampler(make_sic(3))
+    out = sample(pd.to_datetime(['2020-01-02 12:00', '2020-01-05 00:00']), [0, 0], [90, 90])
+    np.testing.assert_array_equal(out, [90, np.nan])
+
+
+def test_sic_sampler_without_days():
+    with pytest.raises(ValueError):
+        sic_sampler(make_sic(0))
@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+import pyproj
+from icedrift.projection import project, projected_xy, add_xy
+
+
+def make_track():
+    return pd.DataFrame({'longitude': [10., 11., 12.], 'latitude': [80., 80.5, 81.]})
+
+
+def test_projected_xy_reuses_columns_only_when_asked():
+    track = make_track()
+    track['x'] = [1., 2., 3.]
+    track['y'] = [4., 5., 6.]
+    x, y = project(track['longitude'].values, track['latitude'].values, 'epsg:3413')
+    np.testing.assert_array_equal(projected_xy(track)[0], x)
+    np.testing.assert_array_equal(projected_xy(track, use_xy=True)[0], track['x'].values)
+
+    add_xy(track)
+    np.testing.assert_array_equal(projected_xy(track, use_xy=True)[1], y)
+
+
+def test_projected_xy_with_pyproj_crs():
+    track = make_track()
+    x, y = project(track['longitude'].values, track['latitude'].values, 'epsg:3413')
+    # A CRS with an EPSG code is the same as its name
+    crs = pyproj.CRS('EPSG:3413')
+    np.testing.assert_allclose(projected_xy(track, crs)[0], x)
+    # A CRS without one is projected, even with use_xy=True
+    crs = pyproj.CRS.from_proj4('+proj=stere +lat_0=90 +lat_ts=75 +lon_0=-45 +datum=WGS84')
+    assert crs.to_epsg() is None
+    track['x'] = 0.
+    track['y'] = 0.
+    xs, ys = projected_xy(track, crs, use_xy=True)
+    expected = pyproj.Transformer.from_crs('epsg:4326', crs, always_xy=True).transform(
+        track['longitude'].values, track['latitude'].values)
+    np.testing.assert_allclose(xs, expected[0])
+    np.testing.assert_allclose(ys, expected[1])
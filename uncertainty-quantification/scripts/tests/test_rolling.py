@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+import pytest
+from icedrift.rolling import rolling_count, rolling_mean_std, rolling_median, rolling_max
+
+
+def make_series(n=500, seed=0):
+    """Irregular times with repeated times, gaps and NaN values."""
+    rng = np.random.default_rng(seed)
+    steps = rng.choice([0, 1, 7, 30, 60, 61, 600], size=n, p=[0.05, 0.05, 0.1, 0.3, 0.3, 0.15, 0.05])
+    t = pd.Timestamp('2020-01-01') + pd.to_timedelta(np.cumsum(steps), unit='min')
+    x = rng.standard_normal(n).cumsum() + 1e4
+    x[rng.choice(n, size=n // 10, replace=False)] = np.nan
+    x[100:130] = np.nan
+    return pd.Series(x, index=pd.DatetimeIndex(t))
+
+
+@pytest.mark.parametrize('window', ['3h', '1D', '3D', '61min'])
+@pytest.mark.parametrize('min_periods', [1, 5])
+def test_rolling_matches_pandas(window, min_periods):
+    s = make_series()
+    t = s.index
+    rolled = s.rolling(window, center=True, min_periods=min_periods)
+
+    np.testing.assert_array_equal(rolling_count(t, s.values, window),
+                                  s.rolling(window, center=True).count().values)
+    mean, std = rolling_mean_std(t, s.values, window, min_periods=min_periods)
+    np.testing.assert_allclose(mean, rolled.mean().values, rtol=1e-9, equal_nan=True)
+    np.testing.assert_allclose(std, rolled.std().values, rtol=1e-6, atol=1e-9, equal_nan=True)
+    np.testing.assert_allclose(rolling_median(t, s.values, window, min_periods=min_periods),
+                               rolled.median().values, equal_nan=True)
+    np.testing.assert_allclose(rolling_max(t, s.values, window, min_periods=min_periods),
+                               rolled.max().values, equal_nan=True)
+
+
+def test_rolling_several_series():
+    t = make_series().index
+    X = np.vstack([make_series(seed=1).values, make_series(seed=2).values])
+    mean, std = rolling_mean_std(t, X, '1D', min_periods=3)
+    median = rolling_median(t, X, '1D', min_periods=3)
+    for k in range(2):
+        rolled = pd.Series(X[k], index=t).rolling('1D', center=True, min_periods=3)
+        np.testing.assert_allclose(mean[k], rolled.mean().values, rtol=1e-9, equal_nan=True)
+        np.testing.assert_allclose(std[k], rolled.std().values, rtol=1e-6, atol=1e-9,
+                                   equal_nan=True)
+        np.testing.assert_allclose(median[k], rolled.median().values, equal_nan=True)
+
+
+def test_rolling_needs_sorted_times():
+    s = make_series()
+    with pytest.raises(ValueError):
+        rolling_count(s.index[::-1], s.values[::-1], '1D')
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+from icedrift.analysis import compute_strain_rate_batch
+from icedrift.projection import unproject
+from icedrift.shape import polygon_metrics, shape_mask, screen_polygons
+
+
+def vertices(points):
+    """(vertex, time) arrays of a polygon with one time step."""
+    points = np.array(points, dtype=float) * 10e3
+    return points[:, :1], points[:, 1:]
+
+
+def test_clockwise_quad_is_valid():
+    X, Y = vertices([[0, 0], [1, 0], [1, 1], [0, 1]])
+    ccw = polygon_metrics(X, Y)
+    cw = polygon_metrics(X[::-1], Y[::-1])
+    assert cw['signed_area'][0] == -ccw['signed_area'][0]
+    np.testing.assert_allclose(cw['min_angle'], 90)
+    np.testing.assert_allclose(cw['max_angle'], 90)
+    assert shape_mask(ccw)[0] and shape_mask(cw)[0]
+
+
+def test_arrowhead_is_not_valid():
+    # Non-convex quad with a reflex angle of about 233 degrees at (1, 1)
+    X, Y = vertices([[0, 0], [2, 0.5], [1, 1], [0.5, 2]])
+    for X_, Y_ in [(X, Y), (X[::-1], Y[::-1])]:
+        metrics = polygon_metrics(X_, Y_)
+        assert metrics['min_angle'][0] > 20
+        assert metrics['max_angle'][0] > 180
+        assert not shape_mask(metrics)[0]
+        assert shape_mask(metrics, max_angle_deg=360)[0]
+
+
+def test_clockwise_quad_in_strain_rate_batch():
+    corners = np.array([[0, 0], [1, 0], [1, 1], [0, 1]]) * 10e3 + [0, -1000e3]
+    time = pd.date_range('2020-01-01', periods=10, freq='1h')
+    stretch = 1 + 1e-3*np.arange(len(time))
+    x, y = corners[:, :1] * stretch, corners[:, 1:] + np.zeros(len(time))
+    lon, lat = unproject(x.ravel(), y.ravel())
+    cube = xr.Dataset({'longitude': (('buoy', 'time'), lon.reshape(x.shape)),
+                       'latitude': (('buoy', 'time'), lat.reshape(x.shape))},
+                      coords={'buoy': ['a', 'b', 'c', 'd'], 'time': time})
+    polygons = [['a', 'b', 'c', 'd'], ['d', 'c', 'b', 'a']]
+    screen = screen_polygons(polygons, cube)
+    assert screen['valid'].values.all()
+    strain = compute_strain_rate_batch(polygons, cube, valid=screen['valid'].values)
+    ccw, cw = strain['divergence'].values
+    assert np.isfinite(ccw[1:-1]).all()
+    np.testing.assert_allclose(cw, ccw, rtol=1e-9)